@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""Compares request latency under each of lazyboy's balancing policies.
+
+Three stand-in servers each handle 4 requests at a time in 1-3ms, but
+one of them stops for 150ms every 600ms, like a node in a GC pause or
+compaction. 12 threads share one Client and make reads back to back.
+"""
+
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from lazyboy import connection
+from standins import StandInClient
+
+
+def run(balancer, threads=12, number=150):
+    """Returns the sorted latencies of reads using the given balancer."""
+    # Server states are kept by name, so each run gets its own servers
+    servers = ["%s-%s:9160" % (balancer, name) for name in "abc"]
+    slow = servers[1]
+    slots = dict((server, threading.Semaphore(4)) for server in servers)
+    start = time.time()
+
+    def serve(server, method, *args):
+        slots[server].acquire()
+        try:
+            if server == slow:
+                phase = (time.time() - start) % 0.6
+                if phase < 0.15:
+                    time.sleep(0.15 - phase)
+            time.sleep(random.uniform(0.001, 0.003))
+        finally:
+            slots[server].release()
+
+    client = StandInClient(servers, serve, balancer=balancer)
+    latencies = []
+
+    def read():
+        mine = []
+        for i in xrange(number):
+            began = time.time()
+            client.get_slice("Keyspace", "row")
+            mine.append(time.time() - began)
+            time.sleep(random.uniform(0, 0.004))
+        latencies.extend(mine)
+
+    workers = [threading.Thread(target=read) for i in xrange(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    latencies.sort()
+    return latencies
+
+
+def main():
+    for balancer in sorted(connection.BALANCERS):
+        latencies = run(balancer)
+        percentile = lambda p: latencies[int(len(latencies) * p) - 1] * 1000
+        print "%-18s p50 %5.1fms  p90 %5.1fms  p99 %6.1fms  max %6.1fms" % (
+            balancer, percentile(.5), percentile(.9), percentile(.99),
+            latencies[-1] * 1000)
+
+
+if __name__ == "__main__":
+    main()
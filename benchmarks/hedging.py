@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""Compares read latency with and without hedged reads.
+
+Three stand-in servers answer in 1ms, except that 3% of calls stall for
+50ms. Hedging sends reads slower than the 95th percentile to a second
+server, for up to 5% of reads.
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from standins import StandInClient
+
+
+def serve(server, method, *args):
+    time.sleep(random.random() < 0.03 and 0.05 or 0.001)
+
+
+def run(number=3000, **options):
+    """Returns the sorted latencies of reads, and the client."""
+    # Server states are kept by name, so each run gets its own servers
+    servers = ["%s-%d:9160" % (options and "hedged" or "plain", i)
+               for i in xrange(3)]
+    client = StandInClient(servers, serve, **options)
+    latencies = []
+    for i in xrange(number):
+        start = time.time()
+        client.get_slice("Keyspace", "row")
+        latencies.append(time.time() - start)
+    latencies.sort()
+    return latencies, client
+
+
+def main():
+    for name, options in (("no hedging", {}),
+                          ("hedge at p95", {'hedge_percentile': 95,
+                                            'hedge_ratio': 0.05})):
+        latencies, client = run(**options)
+        percentile = lambda p: latencies[int(len(latencies) * p)] * 1000
+        print "%-13s p50 %5.2fms  p99 %6.2fms  p99.9 %6.2fms  " \
+            "(%d hedges)" % (name, percentile(.5), percentile(.99),
+                             percentile(.999), client.hedges)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""Times parsing a request's start line and headers into an HTTPRequest.
+
+The request looks like one a browser sends to jsondra. For comparison,
+we also time the parser HTTPHeaders used to have, which split each line
+and normalized every header name on each set and get.
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from tornado import httpserver
+
+REQUEST = (
+    "GET /ks/cf/key/ HTTP/1.1\r\n"
+    "Host: localhost:8001\r\n"
+    "User-Agent: Mozilla/5.0 (X11; Linux x86_64)\r\n"
+    "Accept: application/json\r\n"
+    "Accept-Encoding: gzip, deflate\r\n"
+    "Accept-Language: en-US,en;q=0.5\r\n"
+    "Connection: keep-alive\r\n"
+    "Cookie: a=b; c=d\r\n"
+    "X-Forwarded-For: 10.0.0.1\r\n"
+    "Cache-Control: no-cache\r\n\r\n")
+
+
+class _Connection(object):
+    xheaders = False
+
+
+class _SplitHeaders(dict):
+    """The old HTTPHeaders, normalizing each name as it is used."""
+    def __setitem__(self, name, value):
+        dict.__setitem__(self, self._normalize_name(name), value)
+
+    def __getitem__(self, name):
+        return dict.__getitem__(self, self._normalize_name(name))
+
+    def _normalize_name(self, name):
+        return "-".join([w.capitalize() for w in name.split("-")])
+
+    @classmethod
+    def parse(cls, headers_string):
+        headers = cls()
+        for line in headers_string.split("\r\n"):
+            if line:
+                name, value = line.split(": ", 1)
+                headers[name] = value
+        return headers
+
+
+def parse(headers_class, number=50000):
+    """Returns requests per second parsed with the given headers class."""
+    connection = _Connection()
+    start = time.time()
+    for i in xrange(number):
+        eol = REQUEST.find("\r\n")
+        method, uri, version = REQUEST[:eol].split(" ")
+        headers = headers_class.parse(REQUEST[eol:])
+        httpserver.HTTPRequest(
+            method=method, uri=uri, version=version, headers=headers,
+            remote_ip="10.0.0.1", connection=connection)
+        headers["Connection"]
+        headers["Host"]
+        headers.get("Content-Length")
+        headers["Content-Type"] = "application/json"
+    return number / (time.time() - start)
+
+
+def main():
+    for name, headers_class in (("split and normalize", _SplitHeaders),
+                                ("HTTPHeaders.parse", httpserver.HTTPHeaders)):
+        print "%-20s %8.0f requests/s" % (name, parse(headers_class))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""Times reading messages from an IOStream over a socketpair.
+
+Messages of 1KB, 1MB and 50MB are each read with read_until() and with
+read_bytes(), while another thread writes them as fast as it can.
+"""
+
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from tornado import ioloop
+from tornado import iostream
+
+
+def throughput(size, count, method):
+    """Returns the MB/s at which count messages of size bytes are read."""
+    io_loop = ioloop.IOLoop()
+    writer, reader = socket.socketpair()
+    stream = iostream.IOStream(reader, io_loop=io_loop)
+    message = "x" * size + "\r\n"
+    left = [count]
+
+    def read():
+        if method == "read_until":
+            stream.read_until("\r\n", on_message)
+        else:
+            stream.read_bytes(len(message), on_message)
+
+    def on_message(data):
+        left[0] -= 1
+        if left[0]:
+            read()
+        else:
+            io_loop.stop()
+
+    def write():
+        for i in xrange(count):
+            writer.sendall(message)
+    read()
+    thread = threading.Thread(target=write)
+    thread.start()
+    start = time.time()
+    io_loop.start()
+    elapsed = time.time() - start
+    thread.join()
+    writer.close()
+    stream.close()
+    return size * count / elapsed / 1e6
+
+
+def main():
+    for size, count in ((1024, 20000), (1024 * 1024, 50),
+                        (50 * 1024 * 1024, 2)):
+        for method in ("read_until", "read_bytes"):
+            print "%-10s %9d bytes x %5d: %8.1f MB/s" % (
+                method, size, count, throughput(size, count, method))
+
+
+if __name__ == "__main__":
+    main()
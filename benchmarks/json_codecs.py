@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+"""Times each installed JSON codec encoding and decoding with tornado.escape.
+
+The value is a list of small records like the ones jsondra serves. The
+fastest codec is listed first, so you can pick one for
+escape.set_json_codec() at startup.
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from tornado import escape
+
+
+def codecs(value, number=1000):
+    """Returns a list of (seconds per round trip, name), fastest first."""
+    default = escape.get_json_codec()
+    results = []
+    try:
+        for name in escape.json_codecs():
+            escape.set_json_codec(name)
+            start = time.time()
+            for i in xrange(number):
+                escape.json_decode(escape.json_encode(value))
+            results.append(((time.time() - start) / number, name))
+    finally:
+        escape.set_json_codec(default)
+    results.sort()
+    return results
+
+
+def main():
+    value = [dict(key="key%d" % i, name=u"Record %d" % i, count=i,
+                  score=i / 7.0, tags=["a", "b"], active=bool(i % 2))
+             for i in xrange(100)]
+    for seconds, name in codecs(value):
+        print "%-18s %8.1fus per encode and decode" % (name, seconds * 1e6)
+
+
+if __name__ == "__main__":
+    main()
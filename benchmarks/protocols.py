@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""Times encoding and decoding typical Cassandra payloads with each protocol.
+
+For each row width, we use the reply to a get_slice of that many columns
+and the arguments to a batch_insert of that many columns. 'binary-python'
+is the binary protocol without Thrift's C extension, for comparison.
+Protocols which the installed Thrift lacks are left out.
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from cassandra import Cassandra
+from cassandra.ttypes import Column, ColumnOrSuperColumn
+from thrift.protocol import TBinaryProtocol
+from thrift.transport import TTransport
+
+from lazyboy import connection
+
+
+def protocols():
+    """Returns (name, protocol class) for each protocol we can time."""
+    available = []
+    for (name, protocol) in sorted(connection.PROTOCOLS.items()) + [
+            ('binary-python', TBinaryProtocol.TBinaryProtocol)]:
+        try:
+            protocol(TTransport.TMemoryBuffer())
+        except ImportError:
+            continue
+        available.append((name, protocol))
+    return available
+
+
+def time_payload(value, protocol, number):
+    """Returns (encode seconds, decode seconds, bytes) for one value."""
+    start = time.time()
+    for i in xrange(number):
+        buf = TTransport.TMemoryBuffer()
+        value.write(protocol(buf))
+    encoded = (time.time() - start) / number
+    data = buf.getvalue()
+    start = time.time()
+    for i in xrange(number):
+        value.__class__().read(protocol(TTransport.TMemoryBuffer(data)))
+    return encoded, (time.time() - start) / number, len(data)
+
+
+def main(widths=(1, 10, 100, 1000), number=100):
+    available = protocols()
+    for width in widths:
+        columns = [ColumnOrSuperColumn(column=Column(
+                    "column%d" % i, "%032d" % i, int(time.time() * 1e6)))
+                   for i in xrange(width)]
+        payloads = [
+            ('get_slice', Cassandra.get_slice_result(success=columns)),
+            ('batch_insert', Cassandra.batch_insert_args(
+                    "Keyspace1", "key", {"Standard1": columns}, 1))]
+        for (payload, value) in payloads:
+            for (name, protocol) in available:
+                encoded, decoded, size = time_payload(value, protocol, number)
+                print "%-12s %4d columns %-13s %9.1fus encode %9.1fus " \
+                    "decode %7d bytes" % (payload, width, name,
+                                          encoded * 1e6, decoded * 1e6, size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""Compares the memory and save time of Record and CompactRecord.
+
+Like a batch job, we load records of 10, 1,000 and 100,000 columns,
+then change one column of each and save it. Saves go to a stand-in
+client, so no server is needed. Each measurement runs in its own
+process, and memory is the growth in resident size, so this needs
+Linux's /proc.
+"""
+
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from cassandra.ttypes import Column
+
+from lazyboy import record
+from lazyboy.key import Key
+
+
+class _Client(object):
+    def batch_insert(self, *args):
+        pass
+
+    def remove(self, *args):
+        pass
+
+
+_CLIENT = _Client()
+
+
+class _Record(record.Record):
+    def _get_cas(self, keyspace=None):
+        return _CLIENT
+
+
+class _CompactRecord(record.CompactRecord):
+    __slots__ = ()
+
+    def _get_cas(self, keyspace=None):
+        return _CLIENT
+
+
+def _resident():
+    pages = int(open("/proc/self/statm").read().split()[1])
+    return pages * os.sysconf("SC_PAGE_SIZE")
+
+
+def measure(cls, width, number):
+    """Returns (bytes per record, seconds per save) for number records."""
+    key = Key("Keyspace", "ColumnFamily", "row")
+    before = _resident()
+    records = []
+    for i in xrange(number):
+        columns = [Column("column%06d" % c, "value %d" % c, 1)
+                   for c in xrange(width)]
+        records.append(cls()._inject(key, columns))
+    del columns
+    start = time.time()
+    for each in records:
+        each["column000000"] = "changed"
+        each.save()
+    save = (time.time() - start) / number
+    return (_resident() - before) / float(number), save
+
+
+def main():
+    for width, number in ((10, 20000), (1000, 200), (100000, 2)):
+        for name in ("_Record", "_CompactRecord"):
+            subprocess.check_call([sys.executable, __file__, name,
+                                   str(width), str(number)])
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4:
+        cls = globals()[sys.argv[1]]
+        width, number = int(sys.argv[2]), int(sys.argv[3])
+        size, save = measure(cls, width, number)
+        print "%6d columns, %-13s %11.0f bytes per record, %9.1fus " \
+            "per save" % (width, cls.__name__.lstrip("_"), size, save * 1e6)
+    else:
+        main()
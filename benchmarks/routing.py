@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""Times finding the handler for a request path.
+
+The matched route is the last one of 5 or 500, so trying each pattern in
+order, as Application used to, is at its slowest. Paths are either all
+different or all the same, since repeated paths hit the route cache.
+"""
+
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from tornado import web
+
+
+class _Handler(web.RequestHandler):
+    pass
+
+
+class _Request(object):
+    def __init__(self, path):
+        self.path = path
+        self.host = "localhost"
+
+
+def find(routes, requests):
+    """Returns (seconds per linear scan, seconds per _find_route)."""
+    patterns = [re.compile(pattern + "$") for pattern, handler in routes]
+    start = time.time()
+    for request in requests:
+        for pattern in patterns:
+            if pattern.match(request.path):
+                break
+    linear = (time.time() - start) / len(requests)
+    application = web.Application(routes)
+    start = time.time()
+    for request in requests:
+        application._find_route(request)
+    return linear, (time.time() - start) / len(requests)
+
+
+def main(number=50000):
+    for count in (5, 500):
+        routes = [(r"/r%d/(\w+)" % i, _Handler) for i in xrange(count - 1)]
+        routes.append((r"/last/(\w+)", _Handler))
+        for name, requests in (
+            ("different", [_Request("/last/%d" % i) for i in xrange(number)]),
+            ("repeated", [_Request("/last/1")] * number)):
+            linear, indexed = find(routes, requests)
+            print "%3d routes, %-9s paths: %6.2fus linear, %6.2fus " \
+                "_find_route" % (count, name, linear * 1e6, indexed * 1e6)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""Stand-in Cassandra servers for the lazyboy benchmarks.
+
+StandInClient is a lazyboy Client whose servers are a Python function,
+so we can give servers whatever latency we like without running any.
+"""
+
+import functools
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from lazyboy import connection
+
+
+class StandInClient(connection.Client):
+
+    """A Client which calls serve(server, method, *args) for each call.
+
+    Whatever serve returns is the call's result, and whatever it raises
+    is the call's error. Every other argument is passed on to Client.
+    """
+
+    def __init__(self, servers, serve, **kwargs):
+        self._serve = serve
+        connection.Client.__init__(self, servers, **kwargs)
+
+    def _open(self, index, timeout=None):
+        return _Connection(self._servers[index], self._serve)
+
+
+class _Transport(object):
+    def __init__(self):
+        self._open = True
+
+    def isOpen(self):
+        return self._open
+
+    def close(self):
+        self._open = False
+
+    def setTimeout(self, ms):
+        pass
+
+
+class _Connection(object):
+    def __init__(self, server, serve):
+        # The transport stands in for the socket too
+        self.transport = self.socket = _Transport()
+        self.timeout = None
+        self._server = server
+        self._serve = serve
+
+    def __getattr__(self, attr):
+        if attr.startswith("_"):
+            raise AttributeError(attr)
+        return functools.partial(self._serve, self._server, attr)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""Times rendering a template that extends a base and includes another.
+
+We render a page of 10 rows and one of 20,000 rows three ways: running
+the template's module code on each render to define _execute, as
+generate() used to, generate(), and generate_stream(). For streaming
+we also time how long the first piece takes.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from tornado import template
+
+TEMPLATES = {
+    "base.html": """<html>
+  <head><title>{% block title %}Default{% end %}</title></head>
+  <body>
+    {% include "header.html" %}
+    <ul>
+    {% for row in rows %}
+      {% block row %}<li>{{ escape(row["name"]) }}</li>{% end %}
+    {% end %}
+    </ul>
+  </body>
+</html>
+""",
+    "header.html": """<div class="header">{{ title }} {{ len(rows) }}</div>
+""",
+    "page.html": """{% extends "base.html" %}
+{% block title %}{{ title }}{% end %}
+{% block row %}<li class="{{ row["id"] % 2 and "odd" or "even" }}"><b>{{ escape(row["name"]) }}</b> {{ row["id"] }}</li>{% end %}
+""",
+}
+
+
+def _exec_each_time(page, **kwargs):
+    namespace = page._namespace(kwargs)
+    exec page.compiled in namespace
+    return namespace["_execute"]()
+
+
+def _stream(page, **kwargs):
+    for chunk in page.generate_stream(**kwargs):
+        pass
+
+
+def render(page, rows, number):
+    """Returns seconds per render for each way of rendering."""
+    results = []
+    for function in (_exec_each_time, page.generate.im_func, _stream):
+        start = time.time()
+        for i in xrange(number):
+            function(page, rows=rows, title="Rows")
+        results.append((time.time() - start) / number)
+    return results
+
+
+def first_piece(page, rows):
+    """Returns the seconds until generate_stream yields its first piece."""
+    start = time.time()
+    page.generate_stream(rows=rows, title="Rows").next()
+    return time.time() - start
+
+
+def main():
+    directory = tempfile.mkdtemp()
+    try:
+        for name, text in TEMPLATES.iteritems():
+            open(os.path.join(directory, name), "w").write(text)
+        page = template.Loader(directory).load("page.html")
+        for count, number in ((10, 20000), (20000, 20)):
+            rows = [{"id": i, "name": "row <%d>" % i} for i in xrange(count)]
+            assert "".join(page.generate_stream(rows=rows, title="Rows")) == \
+                page.generate(rows=rows, title="Rows")
+            exec_each_time, generate, stream = render(page, rows, number)
+            print "%5d rows: %9.1fus exec each time, %9.1fus generate, " \
+                "%9.1fus generate_stream, %6.1fus to first piece" % (
+                    count, exec_each_time * 1e6, generate * 1e6,
+                    stream * 1e6, first_piece(page, rows) * 1e6)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
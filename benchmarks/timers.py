@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""Times IOLoop timeouts with many of them live at once.
+
+Each request sets a deadline and each connection an idle timeout, and
+most are removed before they expire, so we time adding and removing a
+timeout with 100,000 others waiting, and then running them when they
+all come due at once.
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from tornado import ioloop
+
+
+def churn(live, number=100000):
+    """Returns the seconds to remove one timeout and add another."""
+    io_loop = ioloop.IOLoop()
+    later = time.time() + 1000
+    callback = lambda: None
+    timeouts = [io_loop.add_timeout(later + random.random() * 100, callback)
+                for i in xrange(live)]
+    start = time.time()
+    for i in xrange(number):
+        index = random.randrange(live)
+        io_loop.remove_timeout(timeouts[index])
+        timeouts[index] = io_loop.add_timeout(
+            later + random.random() * 100, callback)
+    return (time.time() - start) / number
+
+
+def expire(live):
+    """Returns the seconds per timeout to run live timeouts due now."""
+    io_loop = ioloop.IOLoop()
+    now = time.time()
+    fired = [0]
+
+    def callback():
+        fired[0] += 1
+        if fired[0] == live:
+            io_loop.stop()
+    for i in xrange(live):
+        io_loop.add_timeout(now - random.random(), callback)
+    start = time.time()
+    io_loop.start()
+    return (time.time() - start) / live
+
+
+def main():
+    for live in (1000, 10000, 100000):
+        print "%7d live timeouts: %6.2fus per remove + add, " \
+            "%6.2fus per expiry" % (live, churn(live) * 1e6,
+                                    expire(live) * 1e6)
+
+
+if __name__ == "__main__":
+    main()
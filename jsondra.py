@@ -17,14 +17,26 @@
 __author__="jbowman"
 __date__ ="$Dec 5, 2009 11:10:21 AM$"
 
+import functools
+import math
+import mmap
+import multiprocessing
+import os
+import Queue
+import struct
+import sys
+import threading
+import time
 import tornado.escape
 import tornado.httpserver
+import tornado.ioloop
 import tornado.options
 import tornado.web
 import tornado.template
 
 from lazyboy import *
 from lazyboy import record
+from lazyboy.exceptions import ErrorCassandraDeadlineExceeded
 from lazyboy.key import Key
 
 from tornado.options import define, options
@@ -32,116 +44,455 @@ from tornado.options import define, options
 define("port", default=8001, help="run on the given port", type=int)
 define("cassandra_pool", default="127.0.0.1:9160", multiple=True,
     help="Cassandra hosts for pool")
+define("cassandra_balancer", default="round_robin",
+    help="how to pick a Cassandra host for each request: round_robin, "
+    "least_outstanding, peak_ewma or p2c")
+define("cassandra_weights", multiple=True,
+    help="relative weights of Cassandra hosts, as host:port=weight; "
+    "0 drains a host")
+define("cassandra_token_aware", default=False, type=bool,
+    help="send requests for a key to a Cassandra host holding it")
+define("cassandra_partitioner", default="random",
+    help="partitioner Cassandra uses: random or order_preserving")
+define("cassandra_hedge_percentile", type=float,
+    help="send reads slower than this percentile to a second host too")
+define("cassandra_transport", default="buffered",
+    help="Thrift transport Cassandra uses: buffered or framed")
+define("cassandra_protocol", default="binary",
+    help="Thrift protocol Cassandra uses: binary or compact")
+define("cassandra_health_check_interval", default=5.0, type=float,
+    help="seconds between probes of Cassandra hosts marked down; 0 to "
+    "only retry them with requests")
+define("cassandra_health_check_timeout", default=1.0, type=float,
+    help="seconds a probe may take to connect to a Cassandra host")
+define("request_timeout", type=float,
+    help="seconds a request may take before we give up with a 504")
+define("max_in_flight", default=100, type=int,
+    help="most requests to handle at once; the limit adapts below this")
+define("max_queued", default=200, type=int,
+    help="reject requests while this many Cassandra calls are outstanding")
+define("target_delay", default=0.005, type=float,
+    help="shed load while requests wait longer than this, in seconds")
+define("rate_limit_header", default="",
+    help="header identifying clients for rate limits, e.g. X-Api-Key; "
+    "by default we use the client's IP address")
+define("read_rate", default=100.0, type=float,
+    help="reads per second allowed to each client; 0 for no limit")
+define("read_burst", default=200.0, type=float,
+    help="reads each client may make at once after being idle")
+define("write_rate", default=50.0, type=float,
+    help="columns written per second allowed to each client; 0 for no limit")
+define("write_burst", default=100.0, type=float,
+    help="columns each client may write at once after being idle")
+define("rate_limit_clients", default=65536, type=int,
+    help="clients to track for rate limits; the least recent are dropped")
+define("bulkhead", multiple=True,
+    help="keyspaces given their own Cassandra workers, as keyspace or "
+    "name=keyspace+keyspace[:workers[:queue]]; others share the bulkhead "
+    "named default, which can't be redefined")
+define("bulkhead_workers", default=4, type=int,
+    help="threads making Cassandra calls for each bulkhead")
+define("bulkhead_queue", default=64, type=int,
+    help="requests each bulkhead queues before rejecting more with a 503")
 define("debug", default=False, help="turn debugging on or off")
 
 class Application(tornado.web.Application):
     def __init__(self):
         handlers = [
-            (r"/(.*?)/(.*?)/(.*?)/", RecordHandler), # key
-            (r"/(.*?)/(.*?)/", RecordHandler), # no key
+            (r"/health", HealthHandler),
+            (r"/metrics", MetricsHandler),
+            (r"/([^/]*)/([^/]*)/(.*)/", RecordHandler), # key
+            (r"/([^/]*)/(.*)/", RecordHandler), # no key
         ]
         if type(options.cassandra_pool) is not "list":
             cassandra_pool = [options.cassandra_pool]
         else:
             cassandra_pool = options.cassandra_pool
+        cassandra_weights = {}
+        for weight in options.cassandra_weights:
+            host, weight = weight.rsplit("=", 1)
+            cassandra_weights[host] = float(weight)
         settings = dict(
             cassandra_pool=cassandra_pool,
+            cassandra_balancer=options.cassandra_balancer,
+            cassandra_weights=cassandra_weights,
+            cassandra_token_aware=options.cassandra_token_aware,
+            cassandra_partitioner=options.cassandra_partitioner,
+            cassandra_hedge_percentile=options.cassandra_hedge_percentile,
+            cassandra_transport=options.cassandra_transport,
+            cassandra_protocol=options.cassandra_protocol,
+            request_timeout=options.request_timeout,
+            rate_limit_header=options.rate_limit_header,
+            rate_limits=dict(read=(options.read_rate, options.read_burst),
+                             write=(options.write_rate, options.write_burst)),
+            # Made before the server forks, so all workers share it
+            rate_limit_buckets=TokenBuckets(options.rate_limit_clients),
+            bulkheads=Bulkheads(options.bulkhead, options.bulkhead_workers,
+                                options.bulkhead_queue),
             debug=False,
         )
         tornado.web.Application.__init__(self, handlers, **settings)
 
+class TokenBuckets(object):
+    """ Token buckets for many clients, in memory shared by forked workers.
+
+    The table has a fixed number of slots, so its size is bounded. Each
+    key hashes to a set of WAYS slots, and a key we haven't seen takes
+    the one in its set which was used least recently.
+    """
+    WAYS = 4
+    _SLOT = struct.Struct("qdd") # key hash, tokens, last update
+
+    def __init__(self, size=65536):
+        self._sets = max(1, size // self.WAYS)
+        self._map = mmap.mmap(-1, self._sets * self.WAYS * self._SLOT.size)
+        self._lock = multiprocessing.Lock()
+
+    def take(self, key, cost, rate, burst):
+        """ Takes cost tokens from the bucket for key.
+
+        The bucket holds up to burst tokens, and refills at rate tokens a
+        second. Returns 0 if there were enough tokens, and otherwise the
+        seconds until there will be. Costs larger than burst are let
+        through once the bucket is full, and leave it in debt.
+        """
+        slot = self._SLOT
+        key_hash = hash(key) or 1
+        first = (key_hash % self._sets) * self.WAYS
+        now = time.time()
+        self._lock.acquire()
+        try:
+            offset = oldest = None
+            for i in xrange(first, first + self.WAYS):
+                slot_hash, tokens, updated = slot.unpack_from(
+                    self._map, i * slot.size)
+                if slot_hash == key_hash:
+                    offset = i * slot.size
+                    break
+                if oldest is None or updated < oldest:
+                    offset, oldest = i * slot.size, updated
+            else:
+                tokens, updated = burst, now
+            tokens = min(burst, tokens + (now - updated) * rate)
+            needed = min(cost, burst)
+            if tokens >= needed:
+                tokens -= cost
+                wait = 0
+            else:
+                wait = (needed - tokens) / rate
+            slot.pack_into(self._map, offset, key_hash, tokens, now)
+        finally:
+            self._lock.release()
+        return wait
+
+class Bulkhead(object):
+    """ Worker threads and a bounded queue for one group of keyspaces. """
+    def __init__(self, name, workers, queue_size):
+        self.name = name
+        self.workers = workers
+        self.queue_size = queue_size
+        self.rejected = 0
+        self.completed = 0
+        self.wait_time = 0.0
+        self.run_time = 0.0
+        self.max_wait = 0.0
+        self.max_run = 0.0
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def submit(self, func, callback):
+        """ Calls func() in a worker, then callback(result, exc_info) on
+        the IOLoop. Returns False if the queue is full. """
+        self._lock.acquire()
+        try:
+            if self._pid != os.getpid():
+                # Start our threads in the process which uses them
+                self._pid = os.getpid()
+                self._queue = Queue.Queue(self.queue_size)
+                for i in xrange(self.workers):
+                    thread = threading.Thread(target=self._work,
+                        name="bulkhead-%s-%d" % (self.name, i))
+                    thread.setDaemon(True)
+                    thread.start()
+        finally:
+            self._lock.release()
+        try:
+            self._queue.put_nowait((func, callback, time.time()))
+        except Queue.Full:
+            self.rejected += 1
+            return False
+        return True
+
+    def _work(self):
+        io_loop = tornado.ioloop.IOLoop.instance()
+        queue = self._queue
+        while True:
+            func, callback, queued = queue.get()
+            started = time.time()
+            try:
+                result = (func(), None)
+            except Exception:
+                result = (None, sys.exc_info())
+            finished = time.time()
+            self._lock.acquire()
+            try:
+                self.completed += 1
+                self.wait_time += started - queued
+                self.run_time += finished - started
+                self.max_wait = max(self.max_wait, started - queued)
+                self.max_run = max(self.max_run, finished - started)
+            finally:
+                self._lock.release()
+            io_loop.add_callback(functools.partial(callback, *result))
+
+    def status(self):
+        """ Returns a dict describing this bulkhead, for monitoring. """
+        completed = self.completed or 1
+        return {"name": self.name, "workers": self.workers,
+                "queued": self._pid and self._queue.qsize() or 0,
+                "queue_size": self.queue_size, "rejected": self.rejected,
+                "completed": self.completed,
+                "mean_wait": self.wait_time / completed,
+                "mean_run": self.run_time / completed,
+                "max_wait": self.max_wait, "max_run": self.max_run}
+
+class Bulkheads(object):
+    """ The bulkheads configured for keyspaces, and a default for the rest.
+
+    Keyspaces come from request URLs, so we never make bulkheads (and their
+    threads) for names we weren't told about.
+    """
+    def __init__(self, specs=(), workers=4, queue_size=64):
+        self._groups = {}
+        self._bulkheads = {"default": Bulkhead("default", workers, queue_size)}
+        for spec in specs:
+            parts = spec.split(":")
+            name = parts[0].split("=", 1)[0]
+            parts[0] = parts[0].split("=", 1)[-1]
+            if name == "default":
+                raise ValueError("--bulkhead %s: the default bulkhead is "
+                    "sized with --bulkhead_workers and --bulkhead_queue; "
+                    "give this group another name" % spec)
+            if name in self._bulkheads:
+                raise ValueError("--bulkhead %s: %s is already defined"
+                                 % (spec, name))
+            bulkhead = Bulkhead(name,
+                len(parts) > 1 and int(parts[1]) or workers,
+                len(parts) > 2 and int(parts[2]) or queue_size)
+            self._bulkheads[name] = bulkhead
+            for keyspace in parts[0].split("+"):
+                self._groups[keyspace] = name
+
+    def get(self, keyspace):
+        """ Returns the bulkhead for keyspace. """
+        return self._bulkheads[self._groups.get(keyspace, "default")]
+
+    def status(self):
+        return [self._bulkheads[name].status()
+                for name in sorted(self._bulkheads)]
+
+class HealthHandler(tornado.web.RequestHandler):
+    """ Answers load balancer health checks, even when shedding load. """
+    def get(self):
+        self.write("ok")
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """ Reports load shedding, Cassandra and I/O loop metrics as JSON. """
+    def get(self):
+        admission = self.settings.get("admission")
+        self.set_header("Content-Type", "application/json")
+        self.write(tornado.escape.json_encode({
+            "admission": admission and admission.status(),
+            "bulkheads": self.settings["bulkheads"].status(),
+            "servers": connection.server_states(),
+            "pools": connection.pool_states(),
+            "ioloop": tornado.ioloop.IOLoop.instance().stats(),
+        }))
+
 class RecordHandler(tornado.web.RequestHandler):
     """ Validates correct arguments to build key is passed. """
+    def prepare(self):
+        self._check_rate_limit()
+
+    def _check_rate_limit(self):
+        """ Turns the client away if it has used up its budget. """
+        if self.request.method in ("GET", "HEAD"):
+            kind, cost = "read", 1
+        elif self.request.method in ("POST", "PUT"):
+            # Writes cost a token per column
+            value = self._get_value()
+            cost = isinstance(value, (dict, list)) and len(value) or 1
+            kind, cost = "write", max(1, cost)
+        else:
+            kind, cost = "write", 1
+        rate, burst = self.settings["rate_limits"][kind]
+        if not rate:
+            return
+        header = self.settings.get("rate_limit_header")
+        client = header and self.request.headers.get(header) or \
+            self.request.remote_ip
+        wait = self.settings["rate_limit_buckets"].take(
+            (client, kind), cost, rate, burst)
+        if wait:
+            self.set_status(503)
+            self.set_header("Retry-After", int(math.ceil(wait)))
+            self.finish("%s rate limit exceeded" % kind)
+
+    def _get_value(self):
+        """ Returns the JSON value posted in the v argument. """
+        if not hasattr(self, "_value"):
+            try:
+                self._value = tornado.escape.json_decode(
+                    self.get_argument("v"))
+            except:
+                raise tornado.web.HTTPError(500, "missing or invalid value")
+        return self._value
+
     def _initialize_key(self, keyspace, columnfamily, key=None):
-        connection.add_pool(keyspace, self.settings.get('cassandra_pool'))
+        connection.add_pool(keyspace, self.settings.get('cassandra_pool'),
+            balancer=self.settings.get('cassandra_balancer'),
+            weights=self.settings.get('cassandra_weights'),
+            token_aware=self.settings.get('cassandra_token_aware'),
+            partitioner=self.settings.get('cassandra_partitioner'),
+            hedge_percentile=self.settings.get('cassandra_hedge_percentile'),
+            transport=self.settings.get('cassandra_transport'),
+            protocol=self.settings.get('cassandra_protocol'))
         try:
             return Key(keyspace, columnfamily, key)
         except:
             raise tornado.web.HTTPError(404)
 
+    def _run(self, keyspace, work):
+        """ Runs work() in the keyspace's bulkhead, then writes its result.
+
+        Cassandra calls block, so we make them in worker threads. Keyspaces
+        given a bulkhead with --bulkhead get their own threads, so one
+        which is slow can't hold up requests for the others.
+        """
+        deadline = self.deadline
+
+        def call():
+            connection.set_deadline(deadline)
+            try:
+                return work()
+            except ErrorCassandraDeadlineExceeded:
+                raise tornado.web.HTTPError(504)
+
+        bulkhead = self.settings["bulkheads"].get(keyspace)
+        if not bulkhead.submit(call, self.async_callback(self._on_result)):
+            self.set_status(503)
+            self.set_header("Retry-After", 1)
+            self.finish("%s is too busy" % keyspace)
+
+    def _on_result(self, result, error):
+        if error:
+            raise error[0], error[1], error[2]
+        self.set_header("Content-Type", "application/json")
+        self.set_header("Connection", "close")
+        self.finish(tornado.escape.json_encode(result))
+
+    @tornado.web.asynchronous
     def get(self, keyspace, columnfamily, key=None):
         """ HTTP GET request retrieves the key if it exists, otherwise 404 """
         k = self._initialize_key(keyspace, columnfamily, key)
-        r = record.Record()
 
-        try:
-            r.load(k)
-            self.set_header("Content-Type", "application/json")
-            self.set_header("Connection", "close")
-            self.write(tornado.escape.json_encode(r))
-        except:
-            # key not found, throw 404
-            raise tornado.web.HTTPError(404)
+        def load():
+            r = record.Record()
+            try:
+                r.load(k)
+            except ErrorCassandraDeadlineExceeded:
+                raise
+            except:
+                # key not found, throw 404
+                raise tornado.web.HTTPError(404)
+            return r
+        self._run(keyspace, load)
 
     def _put_record(self, keyspace, columnfamily, key=None):
         """ HTTP PUT or POST will create or update the key. """
         k = self._initialize_key(keyspace, columnfamily, key)
-        r = record.Record()
+        v = self._get_value()
 
-        try:
-            v = tornado.escape.json_decode(self.get_argument("v"))
-        except:
-            raise tornado.web.HTTPError(500, "missing or invalid value")
+        def save():
+            r = record.Record()
+            # wrapped in try in order to catch and modify existing keys
+            try:
+                r.load(k)
+                # delete any items removed
+                for i in r:
+                    if not i in v:
+                        del r[v]
+                for i in v:
+                    r[i] = v[i]
 
-        # wrapped in try in order to catch and modify existing keys
-        try:
-            r.load(k)
-            # delete any items removed
-            for i in r:
-                if not i in v:
-                    del r[v]
-            for i in v:
-                r[i] = v[i]
-
-            r.save()
-            # return what r is now, so application can confirm
-            self.set_header("Content-Type", "application/json")
-            self.set_header("Connection", "close")
-            self.write(tornado.escape.json_encode(r))
-        except:
-            r.key = k
-            r["_jsondra_id"] = {"keyspace": keyspace,
-                "columnfamily": columnfamily, "key": k.key}
-            for i in v:
-                r[i] = v[i]
-            r.save()
-            self.set_header("Content-Type", "application/json")
-            self.set_header("Connection", "close")
-            self.write(tornado.escape.json_encode(r))
+                r.save()
+                # return what r is now, so application can confirm
+                return r
+            except ErrorCassandraDeadlineExceeded:
+                raise
+            except:
+                r.key = k
+                r["_jsondra_id"] = {"keyspace": keyspace,
+                    "columnfamily": columnfamily, "key": k.key}
+                for i in v:
+                    r[i] = v[i]
+                r.save()
+                return r
+        self._run(keyspace, save)
 
+    @tornado.web.asynchronous
     def post(self, keyspace, columnfamily, key=None):
         self._put_record(keyspace, columnfamily, key)
 
+    @tornado.web.asynchronous
     def put(self, keyspace, columnfamily, key=None):
         self._put_record(keyspace, columnfamily, key)
 
+    @tornado.web.asynchronous
     def delete(self, keyspace, columnfamily, key=None):
         """ HTTP DELETE will delete the key """
         k = self._initialize_key(keyspace, columnfamily, key)
-        r = record.Record()
 
-        try:
-            r.load(k)
-            r.remove()
-            self.set_header("Content-Type", "application/json")
-            self.set_header("Connection", "close")
-
-            self.write(tornado.escape.json_encode({
+        def remove():
+            r = record.Record()
+            try:
+                r.load(k)
+                r.remove()
+            except ErrorCassandraDeadlineExceeded:
+                raise
+            except:
+                raise tornado.web.HTTPError(404)
+            return {
                 "deletedItem": {
                     "keyspace": keyspace,
                     "columnfamily": columnfamily,
                     "key": key
-                }}))
-        except:
-            raise tornado.web.HTTPError(404)
+                }}
+        self._run(keyspace, remove)
+
+def _queued_calls(bulkheads):
+    return sum(state["outstanding"] for state in connection.server_states()) \
+        + sum(state["queued"] for state in bulkheads.status())
 
 def main():
     tornado.options.parse_command_line()
     # cassandra
     # http server
-    http_server = tornado.httpserver.HTTPServer(Application())
+    application = Application()
+    admission = tornado.httpserver.AdmissionControl(
+        max_in_flight=options.max_in_flight,
+        target_delay=options.target_delay, max_queued=options.max_queued,
+        queued=lambda: _queued_calls(application.settings["bulkheads"]))
+    application.settings["admission"] = admission
+    http_server = tornado.httpserver.HTTPServer(application,
+                                                admission=admission)
     http_server.bind(options.port)
     http_server.start()
+    # After start(), so each forked worker probes from its own IOLoop
+    if options.cassandra_health_check_interval:
+        connection.start_health_checks(
+            options.cassandra_health_check_interval,
+            options.cassandra_health_check_timeout)
     tornado.ioloop.IOLoop.instance().start()
 
 if __name__ == "__main__":
@@ -8,7 +8,7 @@
 
 from lazyboy.connection import add_pool, get_pool
 from lazyboy.key import Key
-from lazyboy.record import Record, MirroredRecord
+from lazyboy.record import Record, CompactRecord, MirroredRecord
 from lazyboy.recordset import RecordSet, KeyRecordSet
 from lazyboy.view import View, PartitionedView
 from lazyboy.iterators import slice_iterator, sparse_get, sparse_multiget, \
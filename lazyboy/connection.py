@@ -7,115 +7,1367 @@
 
 """Lazyboy: Connections."""
 
+import bisect
+import errno
+import functools
+import hashlib
+import heapq
+import logging
+import math
 import random
 import os
+import Queue
+import socket
+import sys
 import threading
+import time
 
 from cassandra import Cassandra
 from thrift import Thrift
 from thrift.transport import TTransport, TSocket
 from thrift.protocol import TBinaryProtocol
 
+try:
+    from thrift.protocol import fastbinary
+except ImportError:
+    fastbinary = None
+
 import lazyboy.exceptions as exc
 
 _SERVERS = {}
+_OPTIONS = {}
 _CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+_RINGS = {}
+_STATES = {}
+_STATES_LOCK = threading.Lock()
+_LOCAL = threading.local()
+
+# Consecutive failures after which we stop sending requests to a server
+FAILURE_THRESHOLD = 3
+
+# How long we leave a failed server alone before trying it again. This
+# doubles every time the server fails again, up to MAX_BACKOFF.
+MIN_BACKOFF = 0.5
+MAX_BACKOFF = 30.0
+
+# Calls which only read, so they may be retried on another server
+_IDEMPOTENT = frozenset([
+        'get', 'get_slice', 'multiget', 'multiget_slice', 'get_count',
+        'get_key_range', 'get_range_slice', 'get_range_slices',
+        'get_string_property', 'get_string_list_property',
+        'describe_keyspace', 'describe_keyspaces', 'describe_ring',
+        'describe_version', 'describe_cluster_name'])
+
+# Calls whose second argument is a row key, and calls whose second
+# argument is a list of row keys, which token-aware clients route
+_KEYED = frozenset(['get', 'get_slice', 'get_count', 'insert',
+                    'batch_insert', 'remove'])
+_MULTI_KEYED = frozenset(['multiget', 'multiget_slice'])
+
+# How often token-aware clients fetch the ring again, in seconds
+RING_REFRESH = 60.0
+
+# Reads of a kind which we need to see before we hedge them, and how
+# many hedges may be saved up to send in a burst
+HEDGE_MIN_SAMPLES = 100
+HEDGE_BURST = 10.0
+
+# Errors which mean the server (or the network to it) failed, as opposed
+# to Cassandra rejecting the request
+_SERVER_ERRORS = (TTransport.TTransportException, socket.error, EOFError)
+
+
+def _compact_protocol(trans):
+    """Return a compact protocol for trans.
+
+    TCompactProtocol is imported here, when it's used, because older
+    versions of Thrift don't have it.
+    """
+    from thrift.protocol import TCompactProtocol
+    return TCompactProtocol.TCompactProtocol(trans)
+
+
+# The Thrift transports and protocols a pool may use. They must match
+# how the Cassandra servers are configured.
+TRANSPORTS = {'buffered': TTransport.TBufferedTransport,
+              'framed': TTransport.TFramedTransport}
+PROTOCOLS = {'binary': TBinaryProtocol.TBinaryProtocolAccelerated,
+             'compact': _compact_protocol}
+_CHECKED = set()
+
 
+def add_pool(name, servers, **options):
+    """Add a connection.
 
-def add_pool(name, servers):
-    """Add a connection."""
-    _SERVERS[name] = servers
+    Any options are passed on to the pool's Clients; see Client.
+    """
+    if options.get('balancer', 'round_robin') not in BALANCERS:
+        raise ValueError("Unknown balancer: %s" % options['balancer'])
+    _check_weights(servers, options.get('weights'))
+    if options.get('transport', 'buffered') not in TRANSPORTS:
+        raise ValueError("Unknown transport: %s" % options['transport'])
+    if options.get('protocol', 'binary') not in PROTOCOLS:
+        raise ValueError("Unknown protocol: %s" % options['protocol'])
+    if options.get('protocol') == 'compact':
+        # Fail now, not on the first call, if Thrift is too old for it
+        from thrift.protocol import TCompactProtocol
+    if _SERVERS.get(name) == servers and _OPTIONS.get(name) == options:
+        return
+    _CLIENTS_LOCK.acquire()
+    try:
+        _SERVERS[name] = servers
+        _OPTIONS[name] = options
+        pid, client = _CLIENTS.pop(name, (None, None))
+    finally:
+        _CLIENTS_LOCK.release()
+    if client and pid == os.getpid():
+        client.close()
 
 
 def get_pool(name):
-    """Return a client for the given pool name."""
-    key = str(os.getpid()) + threading.currentThread().getName() + name
-    if key in _CLIENTS:
-        return _CLIENTS[key]
+    """Return the client for the given pool name.
+
+    Clients are safe to share between threads, so there is one per pool
+    in each process.
+    """
+    pid, client = _CLIENTS.get(name, (None, None))
+    if client and pid == os.getpid():
+        return client
 
+    _CLIENTS_LOCK.acquire()
     try:
-        _CLIENTS[key] = Client(_SERVERS[name])
-        return _CLIENTS[key]
-    except Exception:
-        raise exc.ErrorCassandraClientNotFound(
-            "Pool `%s' is not defined." % name)
+        pid, client = _CLIENTS.get(name, (None, None))
+        if client and pid == os.getpid():
+            return client
+        # Connections inherited from a parent process belong to it
+        try:
+            client = Client(_SERVERS[name], **_OPTIONS.get(name, {}))
+        except Exception:
+            raise exc.ErrorCassandraClientNotFound(
+                "Pool `%s' is not defined." % name)
+        _CLIENTS[name] = (os.getpid(), client)
+        return client
+    finally:
+        _CLIENTS_LOCK.release()
+
+
+def accelerated(transport='buffered', protocol='binary'):
+    """Return True if Thrift's C extension encodes and decodes our calls.
+
+    Only the binary protocol has one, and it needs a transport it can
+    read from directly. Without it, we fall back to pure Python, which
+    is several times slower.
+    """
+    return fastbinary is not None and protocol == 'binary' and \
+        issubclass(TRANSPORTS[transport],
+                   getattr(TTransport, 'CReadableTransport', ()))
+
+
+def _check_acceleration(transport, protocol):
+    """Log, once, whether the C extension is used for our calls."""
+    if (transport, protocol) in _CHECKED:
+        return
+    _CHECKED.add((transport, protocol))
+    if accelerated(transport, protocol):
+        logging.info("Thrift's C extension is active for the %s protocol "
+                     "over the %s transport", protocol, transport)
+    elif protocol == 'binary':
+        logging.warning("Thrift's C extension (fastbinary) is not "
+                        "available; encoding Cassandra calls in pure Python")
+    else:
+        logging.info("The Thrift %s protocol has no C extension; "
+                     "encoding Cassandra calls in pure Python", protocol)
+
+
+def set_deadline(deadline):
+    """Make calls from this thread give up at the given time.
+
+    deadline is a time.time() value, or None for no deadline. Every call
+    to Cassandra, including retries and hedged reads, gets the time which
+    is left as its timeout, and calls made after the deadline fail with
+    ErrorCassandraDeadlineExceeded.
+    """
+    _LOCAL.deadline = deadline
+
+
+def get_deadline():
+    """Return this thread's deadline; see set_deadline()."""
+    return getattr(_LOCAL, 'deadline', None)
+
+
+def pool_states():
+    """Return the connection pool metrics of every pool's servers."""
+    return dict((name, client.pool_states())
+                for (name, (pid, client)) in _CLIENTS.items()
+                if pid == os.getpid())
+
+
+def server_states():
+    """Return the health of every server we have connected to."""
+    _STATES_LOCK.acquire()
+    try:
+        states = sorted(_STATES.items())
+    finally:
+        _STATES_LOCK.release()
+    return [state.status() for (server, state) in states]
+
+
+def start_health_checks(interval=5.0, timeout=1.0, io_loop=None):
+    """Probe failed servers from the given tornado IOLoop.
+
+    Every interval seconds, we try a TCP connection to each server which
+    is down and due to be retried, without blocking the IOLoop. If it
+    connects, the server gets requests again, though one more failure
+    takes it back out. Returns the PeriodicCallback, which you can stop().
+    """
+    from tornado import ioloop
+    io_loop = io_loop or ioloop.IOLoop.instance()
+
+    def check():
+        _STATES_LOCK.acquire()
+        try:
+            states = _STATES.values()
+        finally:
+            _STATES_LOCK.release()
+        for state in states:
+            if state.state == ServerState.DOWN and \
+                    state.retry_at <= time.time():
+                _probe(state, io_loop, timeout)
+
+    callback = ioloop.PeriodicCallback(check, interval * 1000, io_loop)
+    callback.start()
+    return callback
+
+
+def _server_state(server):
+    """Return the shared ServerState for a "host:port" string."""
+    _STATES_LOCK.acquire()
+    try:
+        if server not in _STATES:
+            _STATES[server] = ServerState(server)
+        return _STATES[server]
+    finally:
+        _STATES_LOCK.release()
+
+
+def _probe(state, io_loop, timeout):
+    """Try a non-blocking TCP connection to the server."""
+    host, port = state.server.split(":")
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setblocking(0)
+    done = []
+
+    def finish(error):
+        if done:
+            return
+        done.append(True)
+        io_loop.remove_handler(sock.fileno())
+        io_loop.remove_timeout(expire)
+        sock.close()
+        if error:
+            state.failed(error)
+        else:
+            state.recovered()
+
+    def connected(fd, events):
+        error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        finish(error and socket.error(error, os.strerror(error)))
+
+    try:
+        error = sock.connect_ex((host, int(port)))
+    except (socket.error, ValueError), e:
+        sock.close()
+        state.failed(e)
+        return
+    if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+        sock.close()
+        state.failed(socket.error(error, os.strerror(error)))
+        return
+    expire = io_loop.add_timeout(time.time() + timeout, lambda: finish(
+            socket.timeout("Health check timed out")))
+    io_loop.add_handler(sock.fileno(), connected,
+                        io_loop.WRITE | io_loop.ERROR)
+
+
+def _check_weights(servers, weights):
+    """Raise ValueError unless weights are usable for servers."""
+    weights = [float((weights or {}).get(server, 1)) for server in servers]
+    if [weight for weight in weights if weight < 0]:
+        raise ValueError("Server weights can't be negative: %r" % weights)
+    if servers and not [weight for weight in weights if weight > 0]:
+        raise ValueError("At least one server needs a weight above 0")
+
+
+class RoundRobin(object):
+
+    """Picks servers in turn, in proportion to their weights."""
+
+    def __init__(self, weights):
+        self.weights = weights
+        # Start each client at a different point in the rotation
+        self._current = [random.random() * weight for weight in weights]
+        self._lock = threading.Lock()
+
+    def choose(self, candidates, states):
+        """Return the index of the server to use, out of candidates."""
+        # Smooth weighted round-robin, as in nginx
+        total = 0
+        best = None
+        self._lock.acquire()
+        try:
+            for index in candidates:
+                self._current[index] += self.weights[index]
+                total += self.weights[index]
+                if best is None or \
+                        self._current[index] > self._current[best]:
+                    best = index
+            self._current[best] -= total
+        finally:
+            self._lock.release()
+        return best
+
+
+class LeastOutstanding(object):
+
+    """Picks the server with the fewest requests in progress."""
+
+    def __init__(self, weights):
+        self.weights = weights
+
+    def choose(self, candidates, states):
+        """Return the index of the server to use, out of candidates."""
+        return min(_rotated(candidates), key=lambda index:
+                   states[index].outstanding / self.weights[index])
+
+
+class PeakEWMA(object):
+
+    """Picks the server with the lowest expected latency.
+
+    Each server's latency is tracked as a moving average which jumps up
+    to any slower response at once but decays slowly, and is multiplied
+    by the number of requests in progress there plus one.
+    """
+
+    def __init__(self, weights):
+        self.weights = weights
+
+    def choose(self, candidates, states):
+        """Return the index of the server to use, out of candidates."""
+        now = time.time()
+        return min(_rotated(candidates),
+                   key=lambda index: self.cost(index, states[index], now))
+
+    def cost(self, index, state, now):
+        """Return the expected cost of sending a request to a server."""
+        return state.latency(now) * (state.outstanding + 1) / \
+            self.weights[index]
+
+
+class PowerOfTwoChoices(PeakEWMA):
+
+    """Picks two servers at random, and uses the cheaper one.
+
+    This is nearly as good as comparing every server, and it doesn't send
+    every request to the same server while the estimates catch up.
+    """
+
+    def choose(self, candidates, states):
+        """Return the index of the server to use, out of candidates."""
+        if len(candidates) == 1:
+            return candidates[0]
+        first = self._pick(candidates)
+        second = self._pick([c for c in candidates if c != first])
+        now = time.time()
+        if self.cost(second, states[second], now) < \
+                self.cost(first, states[first], now):
+            return second
+        return first
+
+    def _pick(self, candidates):
+        """Return a random candidate, in proportion to the weights."""
+        point = random.uniform(0, sum(self.weights[c] for c in candidates))
+        for index in candidates:
+            point -= self.weights[index]
+            if point <= 0:
+                return index
+        return candidates[-1]
+
+
+def _rotated(candidates):
+    """Return candidates starting at a random one, so ties are spread."""
+    offset = random.randint(0, len(candidates) - 1)
+    return candidates[offset:] + candidates[:offset]
+
+
+BALANCERS = {'round_robin': RoundRobin,
+             'least_outstanding': LeastOutstanding,
+             'peak_ewma': PeakEWMA,
+             'p2c': PowerOfTwoChoices}
+
+# How quickly PeakEWMA forgets a slow response, in seconds
+EWMA_DECAY = 10.0
+
+
+def _token(key, partitioner):
+    """Return the token Cassandra's partitioner gives a row key."""
+    if partitioner == 'random':
+        # RandomPartitioner takes the absolute value of the MD5 digest,
+        # read as a signed 128 bit integer
+        token = long(hashlib.md5(key).hexdigest(), 16)
+        if token >= 2 ** 127:
+            token = 2 ** 128 - token
+        return token
+    return key
+
+
+class Ring(object):
+
+    """Which servers hold the replicas of each range of tokens.
+
+    ranges is a list of (token, servers) tuples: the servers hold the
+    keys whose tokens fall after the previous token, up to and including
+    this one. Tokens are numbers for the random partitioner and strings
+    for the order-preserving one.
+    """
+
+    def __init__(self, ranges, partitioner='random'):
+        self.partitioner = partitioner
+        ranges = sorted(ranges)
+        self._tokens = [token for (token, servers) in ranges]
+        self._servers = [servers for (token, servers) in ranges]
+
+    @classmethod
+    def from_tokens(cls, tokens, replication_factor=1,
+                    partitioner='random'):
+        """Build a ring from a dict of each server's token.
+
+        Replicas are placed on the next servers around the ring, as
+        Cassandra's rack-unaware strategy does.
+        """
+        nodes = sorted((_parse_token(token, partitioner), server)
+                       for (token, server) in tokens.iteritems())
+        ranges = []
+        for i in xrange(len(nodes)):
+            servers = []
+            for j in xrange(len(nodes)):
+                server = nodes[(i + j) % len(nodes)][1]
+                if server not in servers:
+                    servers.append(server)
+                if len(servers) == replication_factor:
+                    break
+            ranges.append((nodes[i][0], servers))
+        return cls(ranges, partitioner)
+
+    def replicas(self, key):
+        """Return the servers holding the given row key."""
+        if not self._tokens:
+            return []
+        i = bisect.bisect_left(self._tokens, _token(key, self.partitioner))
+        if i == len(self._tokens):
+            i = 0
+        return self._servers[i]
+
+
+def _parse_token(token, partitioner):
+    """Return a token from the ring as we compare it."""
+    if partitioner == 'random':
+        return long(token)
+    return token
+
+
+def _endpoint_indexes(servers):
+    """Map the names a ring may use for each server to its index.
+
+    Rings we configure name servers by "host:port", while those we learn
+    from Cassandra name them by address only.
+    """
+    indexes = {}
+    for (index, server) in enumerate(servers):
+        host = server.split(":")[0]
+        indexes[server] = index
+        indexes.setdefault(host, index)
+        try:
+            indexes.setdefault(socket.gethostbyname(host), index)
+        except socket.error:
+            pass
+    return indexes
+
+
+class ServerState(object):
+
+    """The health of one Cassandra server, shared by all Clients.
+
+    A server is UP until it fails FAILURE_THRESHOLD times in a row, when
+    its circuit breaker opens and it is DOWN. Once its backoff has passed,
+    one request is let through as a probe (PROBING). If that succeeds the
+    server is UP again; if not, it is DOWN for twice as long.
+    """
+
+    UP, DOWN, PROBING = "up", "down", "probing"
+
+    def __init__(self, server):
+        self.server = server
+        self.state = self.UP
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.backoff = 0
+        self.retry_at = 0
+        self.last_error = None
+        self.outstanding = 0
+        self._latency = 0.0
+        self._latency_time = 0.0
+        self._lock = threading.Lock()
+
+    def started(self):
+        """Record that a request was sent to this server."""
+        self._lock.acquire()
+        try:
+            self.outstanding += 1
+        finally:
+            self._lock.release()
+
+    def finished(self, latency=None):
+        """Record that a request finished after latency seconds."""
+        self._lock.acquire()
+        try:
+            self.outstanding -= 1
+            if latency is None:
+                return
+            now = time.time()
+            current = self.latency(now)
+            if latency > current:
+                self._latency = latency
+            else:
+                weight = math.exp(-(now - self._latency_time) / EWMA_DECAY)
+                self._latency = current * weight + latency * (1 - weight)
+            self._latency_time = now
+        finally:
+            self._lock.release()
+
+    def latency(self, now=None):
+        """Return the peak-weighted moving average latency."""
+        if not self._latency:
+            return 0.0
+        now = now or time.time()
+        return self._latency * \
+            math.exp(-(now - self._latency_time) / EWMA_DECAY)
+
+    def available(self):
+        """Return True if a request may be sent to this server now.
+
+        When the server is due to be retried, this returns True for one
+        caller, whose request is the probe.
+        """
+        if self.state == self.UP:
+            return True
+        self._lock.acquire()
+        try:
+            # If a probe never reports back, allow another after a while
+            if self.retry_at > time.time():
+                return False
+            self.state = self.PROBING
+            self.retry_at = time.time() + self.backoff
+            return True
+        finally:
+            self._lock.release()
+
+    def succeeded(self):
+        """Record that the server answered a request."""
+        if self.state == self.UP and not self.consecutive_failures:
+            return
+        self._lock.acquire()
+        try:
+            if self.state != self.UP:
+                logging.info("Cassandra server %s is back up", self.server)
+            self.state = self.UP
+            self.consecutive_failures = 0
+            self.backoff = 0
+        finally:
+            self._lock.release()
+
+    def recovered(self):
+        """Let requests through again after a successful health check."""
+        self._lock.acquire()
+        try:
+            if self.state != self.DOWN:
+                return
+            self.state = self.UP
+            self.consecutive_failures = FAILURE_THRESHOLD - 1
+        finally:
+            self._lock.release()
+
+    def failed(self, error):
+        """Record a failed request, opening the circuit if need be."""
+        self._lock.acquire()
+        try:
+            self.failures += 1
+            self.consecutive_failures += 1
+            self.last_error = str(error)
+            if self.state == self.UP and \
+                    self.consecutive_failures < FAILURE_THRESHOLD:
+                return
+            if self.state == self.UP:
+                self.backoff = MIN_BACKOFF
+            else:
+                self.backoff = min(self.backoff * 2, MAX_BACKOFF)
+            self.state = self.DOWN
+            self.retry_at = time.time() + \
+                self.backoff * random.uniform(0.8, 1.2)
+            logging.warning("Cassandra server %s is down, retrying in "
+                            "%.1fs: %s", self.server, self.backoff, error)
+        finally:
+            self._lock.release()
+
+    def status(self):
+        """Return a dict describing this server, for monitoring."""
+        return {'server': self.server,
+                'state': self.state,
+                'failures': self.failures,
+                'consecutive_failures': self.consecutive_failures,
+                'retry_in': max(0, self.retry_at - time.time())
+                            if self.state != self.UP else 0,
+                'last_error': self.last_error,
+                'outstanding': self.outstanding,
+                'latency': self.latency()}
+
+
+class ConnectionPool(object):
+
+    """A bounded set of connections to one server, shared by threads.
+
+    Callers check a connection out with get() and back in with put().
+    When max_size connections are in use, get() waits for one to come
+    back, for up to wait_timeout seconds if that is set. The most
+    recently used idle connection is handed out first, so when traffic
+    drops the rest stay idle, and are closed after max_idle seconds.
+    Connections are also closed once they are max_age seconds old, so
+    that load spreads back out to servers which were down.
+    """
+
+    def __init__(self, server, connect, max_size=10, max_idle=60.0,
+                 max_age=600.0, wait_timeout=None):
+        self.server = server
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.max_age = max_age
+        self.wait_timeout = wait_timeout
+        self._connect = connect
+        self._idle = []
+        self._size = 0
+        self._reap_at = 0
+        self._cond = threading.Condition(threading.Lock())
+        self.waiting = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.timeouts = 0
+        self.opened = 0
+        self.closed = 0
+
+    def get(self, timeout=None):
+        """Check out a connection, opening a new one if need be.
+
+        If timeout is given, we wait no longer than that for a free
+        connection, and it is the timeout for opening a new one.
+        """
+        wait_timeout = self.wait_timeout
+        if timeout is not None and (wait_timeout is None or
+                                    timeout < wait_timeout):
+            wait_timeout = timeout
+        if self._reap_at <= time.time():
+            self.reap()
+
+        self._cond.acquire()
+        try:
+            start = None
+            while not self._idle and self._size >= self.max_size:
+                now = time.time()
+                if start is None:
+                    start = now
+                    self.waits += 1
+                remaining = None
+                if wait_timeout is not None:
+                    remaining = start + wait_timeout - now
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        raise exc.ErrorCassandraPoolExhausted(
+                            "No connection to %s came free in %.2fs." %
+                            (self.server, wait_timeout))
+                self.waiting += 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self.waiting -= 1
+            if start is not None:
+                waited = time.time() - start
+                self.wait_time += waited
+                self.max_wait = max(self.max_wait, waited)
+            self.checkouts += 1
+            if self._idle:
+                return self._idle.pop()[0]
+            self._size += 1
+        finally:
+            self._cond.release()
+
+        try:
+            connection = self._connect(timeout)
+        except:
+            self._cond.acquire()
+            try:
+                self._size -= 1
+                self._cond.notify()
+            finally:
+                self._cond.release()
+            raise
+        connection.opened_at = time.time()
+        self.opened += 1
+        return connection
+
+    def put(self, connection, discard=False):
+        """Check a connection back in, closing it if discard is set."""
+        now = time.time()
+        discard = discard or now - connection.opened_at >= self.max_age
+        self._cond.acquire()
+        try:
+            if discard:
+                self._size -= 1
+            else:
+                self._idle.append((connection, now))
+            self._cond.notify()
+        finally:
+            self._cond.release()
+        if discard:
+            self._close(connection)
+
+    def reap(self):
+        """Close connections which are idle or old enough to expire."""
+        now = time.time()
+        self._cond.acquire()
+        try:
+            self._reap_at = now + 1
+            keep, expired = [], []
+            for (connection, used) in self._idle:
+                if now - used >= self.max_idle or \
+                        now - connection.opened_at >= self.max_age:
+                    expired.append(connection)
+                else:
+                    keep.append((connection, used))
+            self._idle = keep
+            self._size -= len(expired)
+        finally:
+            self._cond.release()
+        for connection in expired:
+            self._close(connection)
+
+    def clear(self):
+        """Close every idle connection."""
+        self._cond.acquire()
+        try:
+            expired = [connection for (connection, used) in self._idle]
+            self._idle = []
+            self._size -= len(expired)
+        finally:
+            self._cond.release()
+        for connection in expired:
+            self._close(connection)
+
+    def _close(self, connection):
+        """Close a connection, ignoring errors."""
+        self.closed += 1
+        try:
+            connection.transport.close()
+        except Exception:
+            pass
+
+    def status(self):
+        """Return a dict describing this pool, for monitoring."""
+        return {'server': self.server,
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._size - len(self._idle),
+                'max_size': self.max_size,
+                'waiting': self.waiting,
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'wait_time': self.wait_time,
+                'max_wait': self.max_wait,
+                'timeouts': self.timeouts,
+                'opened': self.opened,
+                'closed': self.closed}
+
+
+class _Workers(object):
+
+    """Daemon threads which run functions in the background.
+
+    A thread is started whenever none is idle, and waits for more work
+    once it is done.
+    """
+
+    def __init__(self):
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def run(self, func, *args):
+        """Call func(*args) in a worker thread."""
+        self._lock.acquire()
+        try:
+            if self._pid != os.getpid():
+                # Our threads didn't survive a fork
+                self._pid = os.getpid()
+                self._tasks = Queue.Queue()
+                self._idle = 0
+            start = not self._idle
+            if not start:
+                self._idle -= 1
+        finally:
+            self._lock.release()
+        self._tasks.put((func, args))
+        if start:
+            thread = threading.Thread(target=self._work,
+                                      name="lazyboy-worker")
+            thread.setDaemon(True)
+            thread.start()
+
+    def _work(self):
+        """Run functions as they arrive."""
+        tasks = self._tasks
+        while True:
+            func, args = tasks.get()
+            try:
+                func(*args)
+            except Exception:
+                logging.exception("Error in lazyboy worker")
+            self._lock.acquire()
+            try:
+                self._idle += 1
+            finally:
+                self._lock.release()
+
+
+class _Timer(object):
+
+    """A daemon thread which runs functions after a delay."""
+
+    def __init__(self):
+        self._pid = None
+        self._cond = threading.Condition(threading.Lock())
+
+    def call_later(self, delay, func):
+        """Call func() in the timer thread after delay seconds."""
+        self._cond.acquire()
+        try:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._timeouts = []
+                thread = threading.Thread(target=self._run,
+                                          name="lazyboy-timer")
+                thread.setDaemon(True)
+                thread.start()
+            heapq.heappush(self._timeouts, (time.time() + delay, func))
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def _run(self):
+        """Run functions as they come due."""
+        self._cond.acquire()
+        while True:
+            timeouts = self._timeouts
+            now = time.time()
+            if not timeouts:
+                self._cond.wait()
+            elif timeouts[0][0] > now:
+                self._cond.wait(timeouts[0][0] - now)
+            else:
+                func = heapq.heappop(timeouts)[1]
+                self._cond.release()
+                try:
+                    func()
+                except Exception:
+                    logging.exception("Error in lazyboy timer")
+                self._cond.acquire()
+
+
+_WORKERS = _Workers()
+_TIMER = _Timer()
+
+
+class _LatencyWindow(object):
+
+    """The latencies of the most recent calls of one kind."""
+
+    def __init__(self, size=1000):
+        self._size = size
+        self._samples = []
+        self._next = 0
+        self._sorted = []
+        self._stale = 0
+        self._lock = threading.Lock()
+
+    def add(self, latency):
+        """Record the latency of a call."""
+        self._lock.acquire()
+        try:
+            if len(self._samples) < self._size:
+                self._samples.append(latency)
+            else:
+                self._samples[self._next] = latency
+                self._next = (self._next + 1) % self._size
+            self._stale += 1
+        finally:
+            self._lock.release()
+
+    def percentile(self, percent):
+        """Return the given percentile latency, or None if we don't know."""
+        if len(self._samples) < HEDGE_MIN_SAMPLES:
+            return None
+        # Sorting a thousand floats is cheap, but not cheap enough to do
+        # on every call
+        if self._stale >= len(self._samples) / 10:
+            self._lock.acquire()
+            try:
+                self._sorted = sorted(self._samples)
+                self._stale = 0
+            finally:
+                self._lock.release()
+        samples = self._sorted
+        return samples[min(len(samples) - 1,
+                           int(len(samples) * percent / 100.0))]
 
 
 class Client(object):
 
-    """A wrapper around the Cassandra client which load-balances."""
+    """A wrapper around the Cassandra client which load-balances.
+
+    Servers which keep failing are skipped until they recover; see
+    ServerState. Reads which fail because of the server are retried on
+    the next healthy one. Writes are never retried, since we can't know
+    whether they were applied.
+
+    balancer names the policy used to pick a server for each request; see
+    BALANCERS. weights maps "host:port" to a relative weight (default 1)
+    for servers which should get more or less of the traffic. A weight
+    of 0 drains a server: it gets no requests at all.
+
+    Calls for a row key can be sent straight to a server holding a
+    replica of it, saving Cassandra a hop. Either pass ring, a dict of
+    each server's token, with the replication_factor, or set token_aware
+    to learn the ring of each keyspace from the servers. partitioner is
+    'random' or 'order_preserving', as configured in Cassandra. Multiget
+    calls are split up by replica.
+
+    Each server gets a ConnectionPool of up to max_connections, which
+    are shared by all the threads using this client. timeout is the
+    socket timeout in seconds; the default is to wait forever.
+
+    transport and protocol name the Thrift transport and protocol to
+    use; see TRANSPORTS and PROTOCOLS. They must match the servers'
+    configuration. Only the binary protocol can use Thrift's C extension.
 
-    def __init__(self, servers):
+    If hedge_percentile is set, reads which take longer than that
+    percentile of recent reads of the same kind are sent to a second
+    server too, and whichever answers first wins. hedge_ratio caps the
+    hedges at that fraction of reads. Writes are never hedged.
+    """
+
+    def __init__(self, servers, balancer='round_robin', weights=None,
+                 partitioner='random', ring=None, replication_factor=1,
+                 token_aware=False, max_connections=10, max_idle=60.0,
+                 max_age=600.0, timeout=None, wait_timeout=None,
+                 hedge_percentile=None, hedge_ratio=0.05,
+                 transport='buffered', protocol='binary'):
         """Initialize the client."""
         self._servers = servers
-        self._clients = [s for s in [self._build_server(*server.split(":")) \
-                                         for server in servers] if s]
-        self._current_server = random.randint(0, len(self._clients))
+        self._states = [_server_state(server) for server in servers]
+        self._timeout = timeout
+        self._transport = TRANSPORTS[transport]
+        self._protocol = PROTOCOLS[protocol]
+        _check_acceleration(transport, protocol)
+        self._pools = [ConnectionPool(
+                server, functools.partial(self._open, index),
+                max_connections, max_idle, max_age, wait_timeout)
+                       for (index, server) in enumerate(servers)]
+        _check_weights(servers, weights)
+        weights = [float((weights or {}).get(server, 1))
+                   for server in servers]
+        self._drained = frozenset(index for (index, weight)
+                                  in enumerate(weights) if not weight)
+        self._balancer = BALANCERS[balancer](weights)
+        self._partitioner = partitioner
+        self._replication_factor = replication_factor
+        self._token_aware = token_aware
+        self._static_ring = ring and Ring.from_tokens(
+            ring, replication_factor, partitioner)
+        self._endpoints = None
+        self._hedge_percentile = hedge_percentile
+        self._hedge_ratio = hedge_ratio
+        self._hedge_budget = 0.0
+        self._hedge_lock = threading.Lock()
+        self._latencies = {}
+        self.hedged_reads = 0
+        self.hedges = 0
+        self.hedges_won = 0
+        self.deadlines_exceeded = {}
 
     def _build_server(self, host, port):
         """Return a client for the given host and port."""
-        try:
-            socket = TSocket.TSocket(host, int(port))
-            # socket.setTimeout(200)
-            transport = TTransport.TBufferedTransport(socket)
-            protocol = TBinaryProtocol.TBinaryProtocolAccelerated(transport)
-            client = Cassandra.Client(protocol)
-            client.transport = transport
-            return client
-        except Exception:
-            return None
+        socket = TSocket.TSocket(host, int(port))
+        if self._timeout:
+            socket.setTimeout(self._timeout * 1000)
+        transport = self._transport(socket)
+        protocol = self._protocol(transport)
+        client = Cassandra.Client(protocol)
+        client.socket = socket
+        client.transport = transport
+        client.timeout = self._timeout
+        return client
+
+    def _get_server(self, tried=(), replicas=None):
+        """Return the index of the server to use next.
 
-    def _get_server(self):
-        """Return the next server (round-robin) from the list."""
-        if self._clients is None or len(self._clients) == 0:
+        Servers in tried are skipped. A server which is due to be probed
+        is used first; otherwise the balancer picks one of the servers
+        which are up. If the indexes of replicas are given, we pick one
+        of those if any are available. Returns None if none are.
+        """
+        if not self._servers:
             raise exc.ErrorCassandraNoServersConfigured
 
-        next_server = self._current_server % len(self._clients)
-        self._current_server += 1
-        return self._clients[next_server]
+        for allowed in (replicas, None):
+            candidates = []
+            for (index, state) in enumerate(self._states):
+                if index in tried or index in self._drained or \
+                        (allowed and index not in allowed):
+                    continue
+                if state.state == ServerState.UP:
+                    candidates.append(index)
+                elif state.available():
+                    return index
+            if candidates:
+                return self._balancer.choose(candidates, self._states)
+            if not allowed:
+                return None
 
     def list_servers(self):
         """Return all servers we know about."""
-        return self._clients
+        return list(self._servers)
 
-    def _connect(self, client):
-        """Connect to Cassandra if not connected."""
-        if client.transport.isOpen():
-            return True
+    def server_states(self):
+        """Return the health of each of our servers."""
+        return [state.status() for state in self._states]
 
+    def pool_states(self):
+        """Return the connection pool metrics of each of our servers."""
+        return [pool.status() for pool in self._pools]
+
+    def hedge_status(self):
+        """Return a dict describing our hedged reads, for monitoring."""
+        delays = {}
+        for (attr, latencies) in self._latencies.items():
+            delays[attr] = latencies.percentile(self._hedge_percentile)
+        return {'reads': self.hedged_reads,
+                'hedges': self.hedges,
+                'hedges_won': self.hedges_won,
+                'delays': delays}
+
+    def close(self):
+        """Close every idle connection."""
+        for pool in self._pools:
+            pool.clear()
+
+    def _open(self, index, timeout=None):
+        """Return a new connected client for the server at index."""
+        host, port = self._servers[index].split(":")
         try:
-            client.transport.open()
-            return True
-        except Thrift.TException, texc:
-            if texc.message:
-                message = texc.message
+            client = self._build_server(host, port)
+        except ValueError, e:
+            raise TTransport.TTransportException(message=str(e))
+        self._set_timeout(client, timeout)
+        client.transport.open()
+        # Requests are small and we always wait for the reply, so
+        # don't let Nagle's algorithm hold them back
+        handle = getattr(getattr(client, 'socket', None), 'handle', None)
+        if handle is not None:
+            handle.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return client
+
+    def _set_timeout(self, client, timeout):
+        """Set the socket timeout of client for a call.
+
+        The call may take no longer than timeout, if given, or the
+        timeout we were configured with.
+        """
+        if timeout is None or (self._timeout and self._timeout < timeout):
+            timeout = self._timeout
+        if getattr(client, 'timeout', None) != timeout and \
+                hasattr(client, 'socket'):
+            client.socket.setTimeout(timeout and timeout * 1000)
+            client.timeout = timeout
+
+    def _deadline_exceeded(self, attr):
+        """Count a call which ran out of time, and return its error."""
+        self.deadlines_exceeded[attr] = \
+            self.deadlines_exceeded.get(attr, 0) + 1
+        return exc.ErrorCassandraDeadlineExceeded(
+            "Deadline exceeded before %s finished." % attr)
+
+    def _ring(self, keyspace):
+        """Return the Ring for keyspace, or None if we don't know it."""
+        if self._static_ring or not self._token_aware:
+            return self._static_ring
+
+        cache_key = (tuple(self._servers), keyspace)
+        ring, fetched = _RINGS.get(cache_key, (None, 0))
+        if time.time() - fetched >= RING_REFRESH:
+            # Keep using what we have until the new ring arrives, and
+            # don't let other clients fetch it at the same time.
+            _RINGS[cache_key] = (ring, time.time())
+            ring = self._fetch_ring(keyspace) or ring
+            _RINGS[cache_key] = (ring, time.time())
+        return ring
+
+    def _fetch_ring(self, keyspace):
+        """Ask the servers which of them hold each range of keyspace."""
+        try:
+            ranges = self._send('describe_ring', (keyspace,), {})
+        except Exception, e:
+            logging.warning("Can't fetch the token ring of %s: %s",
+                            keyspace, e)
+            return None
+        return Ring([(_parse_token(token_range.end_token, self._partitioner),
+                      token_range.endpoints) for token_range in ranges],
+                    self._partitioner)
+
+    def _replicas(self, ring, key):
+        """Return the indexes of our servers holding the given row key."""
+        endpoints = self._endpoints
+        if endpoints is None:
+            endpoints = self._endpoints = _endpoint_indexes(self._servers)
+        return frozenset(endpoints[server] for server in ring.replicas(key)
+                         if server in endpoints)
+
+    def _call(self, attr, args, kwargs):
+        """Make a call, sending it to a replica of its key if we can."""
+        deadline = getattr(_LOCAL, 'deadline', None)
+        ring = None
+        if (attr in _KEYED or attr in _MULTI_KEYED) and len(args) > 1:
+            ring = self._ring(args[0])
+        if ring is None:
+            return self._dispatch(attr, args, kwargs, deadline)
+
+        if attr in _KEYED:
+            return self._dispatch(attr, args, kwargs, deadline,
+                                  self._replicas(ring, args[1]))
+
+        owners = {}
+        for key in args[1]:
+            owners.setdefault(self._replicas(ring, key), []).append(key)
+        if len(owners) < 2:
+            return self._dispatch(attr, args, kwargs, deadline,
+                                  owners and owners.keys()[0] or None)
+        # Send each owner its keys at the same time, the last group from
+        # this thread, so the call takes one round trip rather than several
+        answers = Queue.Queue()
+
+        def send(replicas, keys):
+            try:
+                answers.put((True, self._dispatch(
+                            attr, args[:1] + (keys,) + args[2:], kwargs,
+                            deadline, replicas)))
+            except Exception:
+                answers.put((False, sys.exc_info()))
+
+        groups = owners.items()
+        for (replicas, keys) in groups[:-1]:
+            _WORKERS.run(send, replicas, keys)
+        send(*groups[-1])
+        results, error = {}, None
+        for i in xrange(len(groups)):
+            (ok, result) = answers.get()
+            if ok:
+                results.update(result)
             else:
-                message = "Transport error, reconnect"
-            client.transport.close()
-            raise exc.ErrorThriftMessage(message)
-        except Exception:
-            client.transport.close()
+                error = error or result
+        if error:
+            raise error[0], error[1], error[2]
+        return results
+
+    def _dispatch(self, attr, args, kwargs, deadline=None, replicas=None):
+        """Make a call, hedging it if it's a read and we hedge reads."""
+        if self._hedge_percentile is None or attr not in _IDEMPOTENT or \
+                len(self._servers) < 2:
+            return self._send(attr, args, kwargs, deadline, replicas)
+        return self._hedged(attr, args, kwargs, deadline, replicas)
 
-        return False
+    def _hedged(self, attr, args, kwargs, deadline, replicas):
+        """Make a read, sending it to a second server if it's slow.
+
+        If no hedge could be sent, the read is made on the calling thread.
+        Otherwise it is made in a worker, so we can return whichever
+        answer comes first.
+        """
+        latencies = self._latencies.get(attr)
+        if latencies is None:
+            latencies = self._latencies[attr] = _LatencyWindow()
+        delay = latencies.percentile(self._hedge_percentile)
+        self._hedge_lock.acquire()
+        try:
+            self.hedged_reads += 1
+            self._hedge_budget = min(self._hedge_budget + self._hedge_ratio,
+                                     HEDGE_BURST)
+            can_hedge = delay is not None and self._hedge_budget >= 1 and \
+                (deadline is None or deadline - time.time() > delay)
+        finally:
+            self._hedge_lock.release()
+
+        if not can_hedge:
+            start = time.time()
+            result = self._send(attr, args, kwargs, deadline, replicas)
+            latencies.add(time.time() - start)
+            return result
+
+        results = Queue.Queue()
+        tried = set()
+        # How many attempts were made and answered, and whether the
+        # caller has its answer
+        calls = {'sent': 1, 'received': 0, 'done': False}
+
+        def attempt(hedge):
+            start = time.time()
+            try:
+                result = (True, self._send(attr, args, kwargs, deadline,
+                                           replicas, tried))
+                latencies.add(time.time() - start)
+            except Exception:
+                result = (False, sys.exc_info())
+            results.put((hedge, result))
+
+        def hedge():
+            self._hedge_lock.acquire()
+            try:
+                if calls['done'] or self._hedge_budget < 1 or \
+                        len(tried) >= len(self._servers) or \
+                        (deadline is not None and deadline <= time.time()):
+                    return
+                self._hedge_budget -= 1
+                self.hedges += 1
+                calls['sent'] += 1
+            finally:
+                self._hedge_lock.release()
+            _WORKERS.run(attempt, True)
+
+        _WORKERS.run(attempt, False)
+        _TIMER.call_later(delay, hedge)
+        if deadline is not None:
+            # Don't wait past the deadline, even if the attempts do
+            _TIMER.call_later(max(deadline - time.time(), 0),
+                              lambda: results.put((None, None)))
+
+        error = None
+        while True:
+            hedged, result = results.get()
+            self._hedge_lock.acquire()
+            try:
+                if result is None:
+                    calls['done'] = True
+                    raise self._deadline_exceeded(attr)
+                ok, result = result
+                calls['received'] += 1
+                if ok or calls['received'] == calls['sent']:
+                    calls['done'] = True
+                    if ok and hedged:
+                        self.hedges_won += 1
+                    break
+            finally:
+                self._hedge_lock.release()
+            # The other attempt may still succeed
+            error = error or result
+        if ok:
+            return result
+        error = error or result
+        raise error[0], error[1], error[2]
+
+    def _send(self, attr, args, kwargs, deadline=None, replicas=None,
+              tried=None):
+        """Make a call on the next server, retrying reads if it fails.
+
+        Each try may take whatever time is left before deadline. If
+        replicas is given, we prefer the servers at those indexes.
+        Servers in tried are skipped, and the ones we try are added.
+        """
+        if tried is None:
+            tried = set()
+        while True:
+            index = self._get_server(tried, replicas)
+            if index is None:
+                raise exc.ErrorCassandraNoServersAvailable(
+                    "No Cassandra servers are available.")
+            timeout = None
+            if deadline is not None:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    raise self._deadline_exceeded(attr)
+            tried.add(index)
+            state = self._states[index]
+            pool = self._pools[index]
+            state.started()
+            start = client = None
+            try:
+                try:
+                    client = pool.get(timeout)
+                    self._set_timeout(client, timeout)
+                    # Connecting isn't part of the server's latency
+                    start = time.time()
+                    result = getattr(client, attr)(*args, **kwargs)
+                finally:
+                    state.finished(start and time.time() - start)
+            except exc.ErrorCassandraPoolExhausted:
+                if deadline is not None and deadline <= time.time():
+                    raise self._deadline_exceeded(attr)
+                if attr in _IDEMPOTENT and len(tried) < len(self._servers):
+                    continue
+                raise
+            except _SERVER_ERRORS, error:
+                if client:
+                    pool.put(client, discard=True)
+                if deadline is not None and deadline <= time.time():
+                    # We ran out of time; that's not the server's fault
+                    raise self._deadline_exceeded(attr)
+                state.failed(error)
+                if attr in _IDEMPOTENT and len(tried) < len(self._servers):
+                    continue
+                raise exc.ErrorThriftMessage(
+                    getattr(error, 'message', None) or
+                    "Transport error, reconnect")
+            except Thrift.TException, texc:
+                state.succeeded()
+                if texc.message:
+                    message = texc.message
+                else:
+                    message = "Transport error, reconnect"
+                # Cassandra's reply was read in full, so the connection
+                # can be used again
+                if client:
+                    pool.put(client)
+                raise exc.ErrorThriftMessage(message)
+            except Exception:
+                state.succeeded()
+                if client:
+                    pool.put(client, discard=True)
+                raise
+            state.succeeded()
+            pool.put(client)
+            return result
 
     def __getattr__(self, attr):
         """Wrap every __func__ call to Cassandra client and connect()."""
 
         def func(*args, **kwargs):
             """Wrapper function."""
-            client = self._get_server()
-            if self._connect(client):
-                try:
-                    return getattr(client, attr).__call__(*args, **kwargs)
-                except Thrift.TException, texc:
-                    if texc.message:
-                        message = texc.message
-                    else:
-                        message = "Transport error, reconnect"
-                    client.transport.close()
-                    raise exc.ErrorThriftMessage(message)
-                except Exception:
-                    client.transport.close()
-                    raise
+            return self._call(attr, args, kwargs)
 
         return func
@@ -57,6 +57,21 @@ class ErrorCassandraNoServersConfigured(LazyboyException):
     pass
 
 
+class ErrorCassandraNoServersAvailable(ErrorThriftMessage):
+    """Raised when every server in a pool is down."""
+    pass
+
+
+class ErrorCassandraPoolExhausted(ErrorThriftMessage):
+    """Raised when no connection to a server comes free in time."""
+    pass
+
+
+class ErrorCassandraDeadlineExceeded(ErrorThriftMessage):
+    """Raised when a call runs out of time; see connection.set_deadline."""
+    pass
+
+
 class ErrorImmutable(LazyboyException):
     """Raised on an attempt to modify an immutable object."""
     pass
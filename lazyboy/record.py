@@ -210,13 +210,16 @@ class Record(CassandraBase, dict):
                 for index in self.get_indexes():
                     index.append(self)
         finally:
-            # Clean up internal state
-            if changes['changed']:
-                self._modified.clear()
-            self._original = copy.deepcopy(self._columns)
+            self._saved(changes)
 
         return self
 
+    def _saved(self, changes):
+        """Clean up internal state after saving changes."""
+        if changes['changed']:
+            self._modified.clear()
+        self._original = copy.deepcopy(self._columns)
+
     def _save_internal(self, key, changes, consistency=None):
         """Internal save method."""
 
@@ -262,6 +265,102 @@ class Record(CassandraBase, dict):
         self._modified, self._deleted = {}, {}
 
 
+# The value of a column which doesn't exist
+_MISSING = object()
+
+
+class CompactRecord(Record):
+
+    """A Record which keeps each value once, for wide or numerous records.
+
+    Record keeps every value in three places: itself, a Column in
+    _columns, and another Column in _original, which save() rebuilds
+    with deepcopy. CompactRecord keeps values only in itself. When a
+    column is first changed, it remembers the column's original value,
+    so saving just forgets those, and it only builds Columns for changed
+    values when saving. Its attributes are slots, so it doesn't need an
+    instance dictionary either.
+    """
+
+    __slots__ = ('_clients', 'consistency', 'key',
+                 '_old', '_modified', '_deleted')
+
+    def _clean(self):
+        """Remove every item from the object"""
+        dict.clear(self)
+        self._old, self._modified, self._deleted = {}, {}, {}
+        self.key = None
+
+    def _remember(self, item):
+        """Remember the value item had when loaded, before changing it."""
+        if item not in self._old:
+            self._old[item] = dict.get(self, item, _MISSING)
+
+    def __setitem__(self, item, value):
+        """Set an item, recording it as modified."""
+        if value is None:
+            raise exc.ErrorInvalidValue("You may not set an item to None.")
+
+        value = self.sanitize(value)
+        self._remember(item)
+        dict.__setitem__(self, item, value)
+
+        if item in self._deleted:
+            del self._deleted[item]
+
+        # If this is the value we loaded, there's nothing to save
+        if self._old[item] == value:
+            del self._old[item]
+            self._modified.pop(item, None)
+        else:
+            self._modified[item] = self.timestamp()
+
+    def __delitem__(self, item):
+        self._remember(item)
+        dict.__delitem__(self, item)
+        # Don't record this as a deletion if it wouldn't require a remove()
+        self._deleted[item] = self._old[item] is not _MISSING
+        if item in self._modified:
+            del self._modified[item]
+
+    def _inject(self, key, columns):
+        """Inject columns into the record after they have been fetched.."""
+        self.key = key
+        if isinstance(columns, dict):
+            columns = columns.itervalues()
+
+        dict.clear(self)
+        for col in columns:
+            dict.__setitem__(self, col.name, col.value)
+        self._old, self._modified, self._deleted = {}, {}, {}
+        return self
+
+    def _marshal(self):
+        """Marshal deleted and changed columns."""
+        return {'deleted': tuple(self.key.get_path(column=col)
+                                 for col in self._deleted.keys()),
+                'changed': tuple(Column(name=name, value=self[name],
+                                        timestamp=timestamp)
+                                 for (name, timestamp)
+                                 in self._modified.iteritems())}
+
+    def _saved(self, changes):
+        """Clean up internal state after saving changes."""
+        if changes['changed']:
+            self._modified.clear()
+        self._old.clear()
+
+    def revert(self):
+        """Revert changes, restoring to the state we were in when loaded."""
+        for (item, value) in self._old.iteritems():
+            if value is _MISSING:
+                dict.pop(self, item, None)
+            else:
+                dict.__setitem__(self, item, value)
+
+        self._old, self._modified, self._deleted = {}, {}, {}
+
+
 class MirroredRecord(Record):
 
     """A mirrored (denormalized) record."""
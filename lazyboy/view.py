@@ -5,8 +5,13 @@
 #
 """Lazyboy: Views."""
 
+import collections
 import datetime
+import heapq
+import Queue
+import sys
 import uuid
+from itertools import islice
 
 from cassandra.ttypes import SlicePredicate, SliceRange
 
@@ -15,6 +20,7 @@ from lazyboy.base import CassandraBase
 from lazyboy.iterators import multigetterator, unpack
 from lazyboy.record import Record
 from lazyboy.connection import Client
+import lazyboy.connection as connection
 
 
 def _iter_time(start=None, **kwargs):
@@ -56,11 +62,19 @@ class View(CassandraBase):
         return self._get_cas().get_count(
             self.key.keyspace, self.key.key, self.key, self.consistency)
 
-    def _keys(self, start_col=None, end_col=None):
-        """Return keys in the view."""
-        client = self._get_cas()
+    def _slice(self, start_col, end_col, count, client=None):
+        """Return a single slice of columns from the view row."""
+        client = client or self._get_cas()
         assert isinstance(client, Client), \
             "Incorrect client instance: %s" % client.__class__
+        return client.get_slice(
+            self.key.keyspace, self.key.key, self.key,
+            SlicePredicate(slice_range=SliceRange(
+                    start_col, end_col, self.reversed, count)),
+            self.consistency)
+
+    def _columns(self, start_col=None, end_col=None):
+        """Return columns in the view."""
         last_col = start_col or ""
         end_col = end_col or ""
         chunk_size = self.chunk_size
@@ -70,17 +84,13 @@ class View(CassandraBase):
             # results. We want it in the first pass, but subsequent iterations
             # need to the count adjusted and the first record dropped.
             fudge = int(passes > 0)
-            cols = client.get_slice(
-                self.key.keyspace, self.key.key, self.key,
-                SlicePredicate(slice_range=SliceRange(
-                        last_col, end_col, self.reversed, chunk_size + fudge)),
-                self.consistency)
+            cols = self._slice(last_col, end_col, chunk_size + fudge)
 
             if len(cols) == 0:
                 raise StopIteration()
 
             for col in unpack(cols[fudge:]):
-                yield self.record_key.clone(key=col.value)
+                yield col
 
             last_col = col.name
             passes += 1
@@ -88,10 +98,20 @@ class View(CassandraBase):
             if len(cols) < self.chunk_size:
                 raise StopIteration()
 
+    def _keys(self, start_col=None, end_col=None):
+        """Return keys in the view."""
+        for col in self._columns(start_col, end_col):
+            yield self.record_key.clone(key=col.value)
+
     def __iter__(self):
         """Iterate over all objects in this view."""
         return (self.record_class().load(key) for key in self._keys())
 
+    def _load_columns(self, cols):
+        """Return (column, record) pairs for some columns of the view."""
+        return [(col, self.record_class().load(
+                    self.record_key.clone(key=col.value))) for col in cols]
+
     def _record_key(self, record=None):
         """Return the column name for a given record."""
         return record.key.key if record else str(uuid.uuid1())
@@ -131,6 +151,18 @@ class FaultTolerantView(View):
             except Exception:
                 pass
 
+    def _load_columns(self, cols):
+        """Return (column, record) pairs for some columns, ignoring bad
+        keys."""
+        pairs = []
+        for col in cols:
+            try:
+                pairs.append((col, self.record_class().load(
+                            self.record_key.clone(key=col.value))))
+            except Exception:
+                pass
+        return pairs
+
 
 class BatchLoadingView(View):
 
@@ -157,14 +189,44 @@ class BatchLoadingView(View):
             yield (self.record_class()._inject(
                 self.record_key.clone(key=k.key), data[k.key]))
 
+    def _load_columns(self, cols):
+        """Batch load (column, record) pairs for some columns."""
+        keys = [self.record_key.clone(key=col.value) for col in cols]
+        recs = multigetterator(keys, self.consistency)
 
-class PartitionedView(object):
+        if (self.record_key.keyspace not in recs
+            or self.record_key.column_family not in
+            recs[self.record_key.keyspace]):
+            return []
+
+        data = recs[self.record_key.keyspace][self.record_key.column_family]
+        return [(col, self.record_class()._inject(key, data[key.key]))
+                for (col, key) in zip(cols, keys)]
 
-    """A Lazyboy view which is partitioned across rows."""
 
-    def __init__(self, view_key=None, view_class=None):
+class PartitionedView(object):
+
+    """A Lazyboy view which is partitioned across rows.
+
+    By default partitions are read one after another. Setting
+    parallelism above 1 reads up to that many partitions at once in
+    worker threads, a batch of the view's chunk_size at a time, each
+    through its own view's iterator. Setting ordered merges records from
+    all partitions by column name, honoring the reversed flag of the
+    partition views; records are then loaded with the views'
+    _load_columns, so batch loading views still load in bulk. limit
+    stops iteration after that many records, and no batch read is larger
+    than it. Partitions read in order aren't started until the ones
+    before them turn out to be too short to reach the limit.
+    """
+
+    def __init__(self, view_key=None, view_class=None, parallelism=1,
+                 ordered=False, limit=None):
         self.view_key = view_key
         self.view_class = view_class
+        self.parallelism = parallelism
+        self.ordered = ordered
+        self.limit = limit
 
     def partition_keys(self):
         """Return a sequence of row keys for the view partitions."""
@@ -176,9 +238,44 @@ class PartitionedView(object):
 
     def __iter__(self):
         """Iterate over records in the view."""
-        for view in (self._get_view(key) for key in self.partition_keys()):
-            for record in view:
-                yield record
+        if self.parallelism > 1 or self.ordered:
+            records = self._fan_out()
+        else:
+            records = (record for view in
+                       (self._get_view(key) for key in self.partition_keys())
+                       for record in view)
+
+        if self.limit is not None:
+            records = islice(records, self.limit)
+        return records
+
+    def _fan_out(self):
+        """Iterate over records, reading partitions concurrently."""
+        views = [self._get_view(key) for key in self.partition_keys()]
+        parallelism = max(self.parallelism, 1)
+        if self.ordered:
+            # Merging needs the next column of every partition
+            sources = [_column_records(view, self.limit) for view in views]
+        else:
+            sources = [iter(view) for view in views]
+        reader = _PartitionReader(sources, [view.chunk_size for view in views],
+                                  parallelism, self.limit)
+        try:
+            if self.ordered:
+                for idx in range(len(views)):
+                    reader.start(idx)
+                streams = [(view, reader.items(idx))
+                           for (idx, view) in enumerate(views)]
+                for (col, record) in _merge(streams):
+                    reader.returned()
+                    yield record
+            else:
+                for idx in range(len(views)):
+                    for record in reader.items(idx, parallelism):
+                        reader.returned()
+                        yield record
+        finally:
+            reader.close()
 
     def _append_view(self, record):
         """Return the view which this record should be appended to.
@@ -193,3 +290,172 @@ class PartitionedView(object):
     def append(self, record):
         """Append a record to the view."""
         return self._append_view(record).append(record)
+
+
+def _column_records(view, limit=None):
+    """Return (column, record) pairs for a view, loading records in
+    batches of its chunk_size, or of limit if that is smaller."""
+    size = view.chunk_size if limit is None else min(view.chunk_size, limit)
+    cols = view._columns()
+    while True:
+        chunk = list(islice(cols, max(size, 1)))
+        if not chunk:
+            return
+        for pair in view._load_columns(chunk):
+            yield pair
+
+
+class _PartitionReader(object):
+
+    """Read partition iterators in worker threads.
+
+    Each started partition has one batch of items at a time read in the
+    background, and at most parallelism batches are read at once. The
+    next batch is read as soon as the previous one arrives, unless limit
+    items are already on hand.
+
+    Partitions which are read in order can be read ahead. With a limit,
+    a partition is only started once those before it have been read and
+    have fewer items than we still need.
+    """
+
+    def __init__(self, sources, sizes, parallelism, limit=None):
+        self.sources = sources
+        self.sizes = sizes
+        self.parallelism = parallelism
+        self.remaining = limit
+        self.buffers = [collections.deque() for source in sources]
+        self.started = [False] * len(sources)
+        self.reading = [False] * len(sources)
+        self.done = [False] * len(sources)
+        self.closed = False
+        self._waiting = collections.deque()
+        self._in_flight = 0
+        self._results = Queue.Queue()
+        self._deadline = connection.get_deadline()
+
+    def start(self, idx):
+        """Start reading a partition in the background."""
+        if not self.started[idx]:
+            self.started[idx] = True
+            self._read(idx)
+
+    def items(self, idx, window=1):
+        """Iterate over the items of a partition, reading ahead in up to
+        window partitions from it."""
+        self.start(idx)
+        buf = self.buffers[idx]
+        while True:
+            self._read_ahead(idx, window)
+            while not buf:
+                if self.done[idx]:
+                    return
+                self._read(idx, True)
+                self._receive()
+            yield buf.popleft()
+
+    def returned(self):
+        """Count an item returned to the caller against the limit.
+
+        Items which are only taken to be merged haven't been returned
+        yet, so they don't count.
+        """
+        if self.remaining is not None:
+            self.remaining -= 1
+
+    def _read_ahead(self, idx, window):
+        """Start the partitions after idx which we may need next."""
+        on_hand = len(self.buffers[idx])
+        for ahead in range(idx + 1, min(idx + window, len(self.sources))):
+            if self.remaining is not None and (
+                    on_hand >= self.remaining or not self.done[ahead - 1]):
+                return
+            self.start(ahead)
+            on_hand += len(self.buffers[ahead])
+
+    def close(self):
+        """Stop reading; batches already being read are thrown away."""
+        self.closed = True
+
+    def _batch_size(self, idx):
+        """Return how many items to read from a partition next."""
+        if self.remaining is None:
+            return self.sizes[idx]
+        return min(self.sizes[idx], self.remaining - len(self.buffers[idx]))
+
+    def _read(self, idx, needed=False):
+        """Queue a batch of a partition to be read, unless we have enough
+        items on hand or it is needed now."""
+        size = self._batch_size(idx)
+        if self.reading[idx] or self.done[idx] or (size <= 0 and not needed):
+            return
+        self.reading[idx] = True
+        self._waiting.append((idx, max(size, 1)))
+        self._dispatch()
+
+    def _dispatch(self):
+        """Read waiting batches, up to parallelism at once."""
+        while self._waiting and self._in_flight < self.parallelism:
+            (idx, size) = self._waiting.popleft()
+            self._in_flight += 1
+            connection._WORKERS.run(self._work, idx, size)
+
+    def _work(self, idx, size):
+        """Read a batch in a worker thread."""
+        if self.closed:
+            return
+        connection.set_deadline(self._deadline)
+        try:
+            items = list(islice(self.sources[idx], size))
+            self._results.put((idx, items, len(items) < size, None))
+        except Exception:
+            self._results.put((idx, [], True, sys.exc_info()))
+        connection.set_deadline(None)
+
+    def _receive(self):
+        """Wait for a batch to arrive, and start reading the next one."""
+        (idx, items, done, error) = self._results.get()
+        self._in_flight -= 1
+        self.reading[idx] = False
+        if error:
+            raise error[0], error[1], error[2]
+        self.buffers[idx].extend(items)
+        self.done[idx] = done
+        self._read(idx)
+        self._dispatch()
+
+
+class _Descending(object):
+
+    """A column name which sorts in reverse order."""
+
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __cmp__(self, other):
+        return cmp(other.name, self.name)
+
+
+def _push_column(heap, idx, view, stream):
+    """Push the next (column, record) pair from a partition stream onto
+    the heap."""
+    try:
+        pair = stream.next()
+    except StopIteration:
+        return
+    name = _Descending(pair[0].name) if view.reversed else pair[0].name
+    heapq.heappush(heap, (name, idx, view, pair, stream))
+
+
+def _merge(streams):
+    """Merge partition (column, record) streams, ordered by column name."""
+    heap = []
+    for (idx, (view, stream)) in enumerate(streams):
+        _push_column(heap, idx, view, stream)
+
+    while heap:
+        (_, idx, view, pair, stream) = heapq.heappop(heap)
+        yield pair
+        _push_column(heap, idx, view, stream)
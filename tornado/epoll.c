@@ -18,13 +18,18 @@
 #include <string.h>
 #include <sys/epoll.h>
 
-#define MAX_EVENTS 24
+/*
+ * The number of events returned by a single epoll_wait call unless the
+ * caller asks for a different batch size. A busy server can have many
+ * sockets ready at once, so this is large to avoid extra system calls.
+ */
+#define DEFAULT_MAX_EVENTS 1024
 
 /*
  * Simple wrapper around epoll_create.
  */
 static PyObject* _epoll_create(void) {
-    int fd = epoll_create(MAX_EVENTS);
+    int fd = epoll_create(DEFAULT_MAX_EVENTS);
     if (fd == -1) {
 	PyErr_SetFromErrno(PyExc_Exception);
 	return NULL;
@@ -61,33 +66,50 @@ static PyObject* _epoll_ctl(PyObject* self, PyObject* args) {
 /*
  * Simple wrapper around epoll_wait. We return None if the call times out and
  * throw an exception if an error occurs. Otherwise, we return a list of
- * (fd, event) tuples.
+ * (fd, event) tuples. The optional third argument is the maximum number of
+ * events to return from one call. A negative timeout waits indefinitely.
  */
 static PyObject* _epoll_wait(PyObject* self, PyObject* args) {
-    struct epoll_event events[MAX_EVENTS];
+    struct epoll_event* events;
     int epfd, timeout, num_events, i;
+    int max_events = DEFAULT_MAX_EVENTS;
     PyObject* list;
     PyObject* tuple;
 
-    if (!PyArg_ParseTuple(args, "ii", &epfd, &timeout)) {
+    if (!PyArg_ParseTuple(args, "ii|i", &epfd, &timeout, &max_events)) {
+        return NULL;
+    }
+    if (max_events <= 0) {
+        PyErr_SetString(PyExc_ValueError, "max_events must be positive");
         return NULL;
     }
 
+    events = PyMem_New(struct epoll_event, max_events);
+    if (events == NULL) {
+        return PyErr_NoMemory();
+    }
+
     Py_BEGIN_ALLOW_THREADS
-    num_events = epoll_wait(epfd, events, MAX_EVENTS, timeout);
+    num_events = epoll_wait(epfd, events, max_events, timeout);
     Py_END_ALLOW_THREADS
     if (num_events == -1) {
+	PyMem_Free(events);
 	PyErr_SetFromErrno(PyExc_Exception);
 	return NULL;
     }
 
     list = PyList_New(num_events);
+    if (list == NULL) {
+	PyMem_Free(events);
+	return NULL;
+    }
     for (i = 0; i < num_events; i++) {
 	tuple = PyTuple_New(2);
 	PyTuple_SET_ITEM(tuple, 0, PyInt_FromLong(events[i].data.fd));
 	PyTuple_SET_ITEM(tuple, 1, PyInt_FromLong(events[i].events));
 	PyList_SET_ITEM(list, i, tuple);
     }
+    PyMem_Free(events);
     return list;
 }
 
@@ -21,25 +21,99 @@ import re
 import xml.sax.saxutils
 import urllib
 
-try:
-    import json
-    assert hasattr(json, "loads") and hasattr(json, "dumps")
-    _json_decode = lambda s: json.loads(s)
-    _json_encode = lambda v: json.dumps(v)
-except:
-    try:
-        import simplejson
-        _json_decode = lambda s: simplejson.loads(_unicode(s))
-        _json_encode = lambda v: simplejson.dumps(v)
-    except ImportError:
+# JSON libraries we know how to use, in order of preference. Each entry
+# is (name, load), where load imports the library and returns its
+# (encode, decode) functions, or raises ImportError.
+_JSON_CODECS = []
+_json_codec = None
+_json_encode = None
+_json_decode = None
+
+
+def register_json_codec(name, load, preferred=False):
+    """Adds a JSON library we can use for json_encode and json_decode.
+
+    load is called with no arguments when the codec is selected. It should
+    import the library and return its (encode, decode) functions, or raise
+    ImportError if the library is not installed. encode should accept
+    keyword options, which json_encode passes through. Preferred codecs
+    go to the front of the list.
+    """
+    codec = (name, load)
+    if preferred:
+        _JSON_CODECS.insert(0, codec)
+    else:
+        _JSON_CODECS.append(codec)
+
+
+def json_codecs():
+    """Returns the names of the installed JSON codecs, preferred first."""
+    names = []
+    for name, load in _JSON_CODECS:
         try:
-            # For Google AppEngine
-            from django.utils import simplejson
-            _json_decode = lambda s: simplejson.loads(_unicode(s))
-            _json_encode = lambda v: simplejson.dumps(v)
+            load()
         except ImportError:
-            raise Exception("A JSON parser is required, e.g., simplejson at "
-                            "http://pypi.python.org/pypi/simplejson/")
+            continue
+        names.append(name)
+    return names
+
+
+def set_json_codec(name=None):
+    """Uses the named JSON codec, or the most preferred installed one."""
+    global _json_codec, _json_encode, _json_decode
+    for codec_name, load in _JSON_CODECS:
+        if name is not None and codec_name != name:
+            continue
+        try:
+            _json_encode, _json_decode = load()
+        except ImportError:
+            if name is not None:
+                raise
+            continue
+        _json_codec = codec_name
+        return
+    if name is not None:
+        raise KeyError("Unknown JSON codec: %s" % name)
+    raise Exception("A JSON parser is required, e.g., simplejson at "
+                    "http://pypi.python.org/pypi/simplejson/")
+
+
+def get_json_codec():
+    """Returns the name of the JSON codec in use."""
+    return _json_codec
+
+
+def _load_ujson():
+    import ujson
+    return ujson.dumps, ujson.loads
+
+
+def _load_simplejson():
+    import simplejson
+    return simplejson.dumps, simplejson.loads
+
+
+def _load_json():
+    import json
+    if not hasattr(json, "loads") or not hasattr(json, "dumps"):
+        # Not the standard library's json, e.g. the old python-json
+        raise ImportError("json has no loads() and dumps()")
+    return json.dumps, json.loads
+
+
+def _load_django_simplejson():
+    # For Google AppEngine
+    from django.utils import simplejson
+    return simplejson.dumps, simplejson.loads
+
+
+register_json_codec("simplejson", _load_simplejson)
+register_json_codec("json", _load_json)
+register_json_codec("django", _load_django_simplejson)
+# ujson is faster, but escapes "/" and (in older versions) rounds floats,
+# so we only use it when asked to with set_json_codec("ujson")
+register_json_codec("ujson", _load_ujson)
+set_json_codec()
 
 
 def xhtml_escape(value):
@@ -52,16 +126,104 @@ def xhtml_unescape(value):
     return re.sub(r"&(#?)(\w+?);", _convert_entity, _unicode(value))
 
 
-def json_encode(value):
-    """JSON-encodes the given Python object."""
-    return _json_encode(value)
+def json_encode(value, **kwargs):
+    """JSON-encodes the given Python object.
+
+    Keyword arguments are passed on to the JSON library, e.g., sort_keys.
+    """
+    return _json_encode(value, **kwargs)
+
+
+def json_iterencode(value, chunk_size=65536):
+    """JSON-encodes the given Python object in pieces of about chunk_size.
+
+    Lists, tuples and dicts are split between their elements, and each
+    element that isn't one of those is encoded in one call to the JSON
+    library, so large results can be sent as they are encoded.
+    """
+    pieces = []
+    size = 0
+    for piece in _iterencode(value):
+        pieces.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield "".join(pieces)
+            pieces = []
+            size = 0
+    if pieces:
+        yield "".join(pieces)
 
 
 def json_decode(value):
-    """Returns Python objects for the given JSON string."""
+    """Returns Python objects for the given JSON string.
+
+    The value may be a UTF-8 byte string or unicode.
+    """
     return _json_decode(value)
 
 
+def _iterencode(value):
+    if isinstance(value, dict) and _splits(value):
+        yield "{"
+        separator = ""
+        for key, item in value.iteritems():
+            if _splits(item):
+                # Let the library format the key, whatever its type
+                yield separator + _json_encode({key: None})[1:-5]
+                for piece in _iterencode(item):
+                    yield piece
+            else:
+                yield separator + _json_encode({key: item})[1:-1]
+            separator = ", "
+        yield "}"
+    elif isinstance(value, (list, tuple)) and _splits(value):
+        yield "["
+        if _splits(value[0]):
+            separator = ""
+            for item in value:
+                yield separator
+                for piece in _iterencode(item):
+                    yield piece
+                separator = ", "
+        else:
+            # Assume the elements are all alike, and encode them in
+            # batches with one library call each
+            for i in xrange(0, len(value), _BATCH_LENGTH):
+                if i:
+                    yield ", "
+                yield _json_encode(value[i:i + _BATCH_LENGTH])[1:-1]
+        yield "]"
+    else:
+        yield _json_encode(value)
+
+
+def _splits(value):
+    if isinstance(value, dict):
+        items = value.itervalues()
+    elif isinstance(value, (list, tuple)):
+        items = value
+    else:
+        return False
+    if len(value) > _SPLIT_LENGTH:
+        return True
+    for item in items:
+        if isinstance(item, _CONTAINERS) and _splits(item):
+            return True
+    return False
+
+
+_CONTAINERS = (dict, list, tuple)
+
+
+# Lists and dicts with at most this many elements, and nothing larger
+# inside them, are encoded whole by json_iterencode, since splitting them
+# costs more than it saves
+_SPLIT_LENGTH = 16
+
+# The most list elements json_iterencode encodes in one call
+_BATCH_LENGTH = 256
+
+
 def squeeze(value):
     """Replace all sequences of whitespace chars with a single space."""
     return re.sub(r"[\x00-\x20]+", " ", value).strip()
@@ -23,6 +23,7 @@ import functools
 import ioloop
 import iostream
 import logging
+import math
 import os
 import socket
 import time
@@ -73,6 +74,29 @@ class HTTPServer(object):
     headers are useful when running Tornado behind a reverse proxy or
     load balancer.
 
+    If the request callback has a start_request() method, it is called
+    with the HTTPRequest as soon as the headers of a request with a body
+    have been read, before any of the body. It can respond to the request
+    right away (e.g., to reject a body that is too large), in which case
+    we close the connection instead of reading the body. It can return an
+    object with data_received(chunk) and finish() methods, in which case
+    the body is passed to data_received() in pieces as it arrives, finish()
+    is called at the end, and the request callback itself is not called.
+    Otherwise it returns None and the body is buffered as usual. If the
+    client sent "Expect: 100-continue", we only send the 100 (Continue)
+    response once start_request() has accepted the request.
+
+    start_request() can also limit the body by setting the request's
+    max_body_size. We enforce it for chunked bodies, whose size isn't known
+    up front, as they arrive: buffered requests get a 413 response, and a
+    consumer with a body_too_large() method is asked to respond.
+
+    To shed load when the server can't keep up, pass an AdmissionControl
+    as the admission argument. Requests it turns away get a 503 (Service
+    Unavailable) response with a Retry-After header as soon as their
+    headers are read, before we read the body or call the request
+    callback.
+
     HTTPServer can serve HTTPS (SSL) traffic with Python 2.6+ and OpenSSL.
     To make this server serve SSL traffic, send the ssl_options dictionary
     argument with the arguments required for the ssl.wrap_socket() method,
@@ -99,7 +123,7 @@ class HTTPServer(object):
     auto-detection.
     """
     def __init__(self, request_callback, no_keep_alive=False, io_loop=None,
-                 xheaders=False, ssl_options=None):
+                 xheaders=False, ssl_options=None, admission=None):
         """Initializes the server with the given request callback.
 
         If you use pre-forking/start() instead of the listen() method to
@@ -112,6 +136,7 @@ class HTTPServer(object):
         self.io_loop = io_loop
         self.xheaders = xheaders
         self.ssl_options = ssl_options
+        self.admission = admission
         self._socket = None
         self._started = False
 
@@ -201,11 +226,140 @@ class HTTPServer(object):
             try:
                 stream = iostream.IOStream(connection, io_loop=self.io_loop)
                 HTTPConnection(stream, address, self.request_callback,
-                               self.no_keep_alive, self.xheaders)
+                               self.no_keep_alive, self.xheaders,
+                               self.admission)
             except:
                 logging.error("Error in connection callback", exc_info=True)
 
 
+class AdmissionControl(object):
+    """Decides which requests an overloaded HTTPServer should turn away.
+
+    We reject a request if:
+
+    - limit requests are already in flight. The limit adapts to latency:
+      while requests take no longer than the fastest we have seen them
+      take recently, it grows towards max_in_flight, and as they slow
+      down (say, because the database behind us is saturated) it shrinks
+      in proportion, down to min_in_flight.
+    - queued() returns max_queued or more, if both are given. Use it to
+      count work queued behind the server, such as database calls.
+    - requests have waited in the I/O loop for longer than target_delay
+      for all of the last interval seconds, as in the CoDel queue
+      management algorithm. Short bursts are let through, but a standing
+      queue is shed until the delay falls below the target again.
+
+    Requests for one of the exempt paths, or for paths below one of them,
+    such as health checks, are always let through and are not counted. Rejected
+    clients are asked to retry after retry_after seconds.
+    """
+    def __init__(self, max_in_flight=100, min_in_flight=4, target_delay=0.005,
+                 interval=0.1, max_queued=None, queued=None,
+                 exempt=("/health", "/metrics"), retry_after=1,
+                 io_loop=None):
+        self.max_in_flight = max_in_flight
+        self.min_in_flight = min_in_flight
+        self.target_delay = target_delay
+        self.interval = interval
+        self.max_queued = max_queued
+        self.queued = queued
+        self.exempt = tuple(exempt)
+        self._exempt_dirs = tuple(path.rstrip("/") + "/" for path in exempt)
+        self.retry_after = retry_after
+        self.io_loop = io_loop
+        self.limit = float(max_in_flight)
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected = dict(limit=0, queued=0, delay=0)
+        self._above_since = None
+        self._dropping = False
+        self._latencies = []
+        self._window_end = 0
+        self._min_latency = None
+        self._min_latency_reset = 0
+
+    # How often we recompute the limit from request latencies, and how
+    # often we forget the fastest latency seen, in seconds
+    _WINDOW = 1.0
+    _MIN_LATENCY_WINDOW = 30.0
+
+    def admit(self, request):
+        """Returns True if the request may go ahead.
+
+        Every request admitted must be released once it is done.
+        """
+        if request.path in self.exempt or \
+           request.path.startswith(self._exempt_dirs):
+            request._admitted = False
+            return True
+        now = time.time()
+        if self.in_flight >= int(self.limit):
+            return self._reject("limit")
+        if self.max_queued is not None and self.queued is not None and \
+           self.queued() >= self.max_queued:
+            return self._reject("queued")
+        io_loop = self.io_loop or ioloop.IOLoop.instance()
+        if self._delayed(io_loop.queue_delay(), now):
+            return self._reject("delay")
+        self.in_flight += 1
+        self.admitted += 1
+        request._admitted = True
+        return True
+
+    def release(self, request):
+        """Records that an admitted request has finished."""
+        if not getattr(request, "_admitted", False):
+            return
+        request._admitted = False
+        self.in_flight -= 1
+        now = time.time()
+        self._latencies.append(now - request._start_time)
+        if now >= self._window_end:
+            self._adapt(now)
+
+    def status(self):
+        """Returns a dictionary describing our state, for monitoring."""
+        return dict(in_flight=self.in_flight, limit=int(self.limit),
+                    admitted=self.admitted, rejected=dict(self.rejected),
+                    dropping=self._dropping, min_latency=self._min_latency)
+
+    def _reject(self, reason):
+        self.rejected[reason] += 1
+        return False
+
+    def _delayed(self, delay, now):
+        if delay < self.target_delay:
+            self._above_since = None
+            self._dropping = False
+            return False
+        if self._above_since is None:
+            self._above_since = now
+        elif now - self._above_since >= self.interval:
+            if not self._dropping:
+                logging.warning("Requests have waited over %.1fms for %.0fms;"
+                                " shedding load", self.target_delay * 1000,
+                                self.interval * 1000)
+            self._dropping = True
+        return self._dropping
+
+    def _adapt(self, now):
+        latencies, self._latencies = self._latencies, []
+        self._window_end = now + self._WINDOW
+        if not latencies:
+            return
+        latency = sum(latencies) / len(latencies)
+        if self._min_latency is None or latency < self._min_latency or \
+           now >= self._min_latency_reset:
+            self._min_latency = latency
+            self._min_latency_reset = now + self._MIN_LATENCY_WINDOW
+        # Shrink in proportion to how much slower requests have become,
+        # but by no more than half at a time. The square root term lets
+        # the limit grow while latency holds steady.
+        gradient = max(0.5, min(1.0, self._min_latency / max(latency, 1e-6)))
+        limit = self.limit * gradient + math.sqrt(self.limit)
+        self.limit = max(self.min_in_flight, min(self.max_in_flight, limit))
+
+
 class HTTPConnection(object):
     """Handles a connection to an HTTP client, executing HTTP requests.
 
@@ -213,19 +367,43 @@ class HTTPConnection(object):
     until the HTTP conection is closed.
     """
     def __init__(self, stream, address, request_callback, no_keep_alive=False,
-                 xheaders=False):
+                 xheaders=False, admission=None):
         self.stream = stream
         self.address = address
         self.request_callback = request_callback
         self.no_keep_alive = no_keep_alive
         self.xheaders = xheaders
+        self.admission = admission
         self._request = None
         self._request_finished = False
+        self._body_pending = False
+        self._body_consumer = None
+        self._body_remaining = 0
+        if admission is not None:
+            self.stream.set_close_callback(self._on_close)
         self.stream.read_until("\r\n\r\n", self._on_headers)
 
-    def write(self, chunk):
+    # Streamed request bodies are passed on in pieces of this size
+    _BODY_CHUNK_SIZE = 65536
+
+    def write(self, chunk, callback=None):
+        """Writes the chunk to the stream.
+
+        If callback is given, it is called once the stream's write buffer
+        has drained below its low water mark.
+        """
         assert self._request, "Request closed"
         self.stream.write(chunk, self._on_write_complete)
+        if callback is not None:
+            self.stream.set_drain_callback(callback)
+
+    def write_file(self, file, offset, count):
+        """Writes count bytes of file, starting at offset, to the stream.
+
+        See IOStream.write_file().
+        """
+        assert self._request, "Request closed"
+        self.stream.write_file(file, offset, count, self._on_write_complete)
 
     def finish(self):
         assert self._request, "Request closed"
@@ -234,11 +412,13 @@ class HTTPConnection(object):
             self._finish_request()
 
     def _on_write_complete(self):
-        if self._request_finished:
+        if self._request_finished and not self.stream.writing():
             self._finish_request()
 
     def _finish_request(self):
-        if self.no_keep_alive:
+        if self.no_keep_alive or self._body_pending:
+            # If we responded before reading the whole body, the rest of
+            # it is still on the wire, so we can't read another request
             disconnect = True
         else:
             connection_header = self._request.headers.get("Connection")
@@ -249,37 +429,193 @@ class HTTPConnection(object):
                 disconnect = connection_header != "Keep-Alive"
             else:
                 disconnect = True
+        if self.admission is not None:
+            self.admission.release(self._request)
         self._request = None
         self._request_finished = False
+        self._body_consumer = None
         if disconnect:
             self.stream.close()
             return
         self.stream.read_until("\r\n\r\n", self._on_headers)
 
     def _on_headers(self, data):
-        eol = data.find("\r\n")
-        start_line = data[:eol]
-        method, uri, version = start_line.split(" ")
-        if not version.startswith("HTTP/"):
-            raise Exception("Malformed HTTP version in HTTP Request-Line")
-        headers = HTTPHeaders.parse(data[eol:])
+        try:
+            eol = data.find("\r\n")
+            method, uri, version = data[:eol].split(" ")
+            if not version.startswith("HTTP/"):
+                raise _BadRequestException(
+                    "Malformed HTTP version in HTTP Request-Line")
+            headers = HTTPHeaders.parse(data[eol + 2:])
+            content_length = int(headers.get("Content-Length", 0))
+            if content_length < 0:
+                raise _BadRequestException("Negative Content-Length")
+        except ValueError, e:
+            self._bad_request(e)
+            return
         self._request = HTTPRequest(
             connection=self, method=method, uri=uri, version=version,
             headers=headers, remote_ip=self.address[0])
+        if self.admission is not None and \
+           not self.admission.admit(self._request):
+            self._overloaded()
+            return
 
-        content_length = headers.get("Content-Length")
-        if content_length:
-            content_length = int(content_length)
-            if content_length > self.stream.max_buffer_size:
-                raise Exception("Content-Length too long")
+        chunked = version == "HTTP/1.1" and \
+            headers.get("Transfer-Encoding", "").lower().endswith("chunked")
+        if content_length or chunked:
+            request = self._request
+            self._body_pending = True
+            consumer = None
+            if hasattr(self.request_callback, "start_request"):
+                consumer = self.request_callback.start_request(request)
+                if self._request is not request or self._request_finished:
+                    # The request was answered without its body
+                    return
+            if consumer is None and \
+               content_length > self.stream.max_buffer_size:
+                self._body_too_large(content_length)
+                return
             if headers.get("Expect") == "100-continue":
                 self.stream.write("HTTP/1.1 100 (Continue)\r\n\r\n")
-            self.stream.read_bytes(content_length, self._on_request_body)
+            self._body_consumer = consumer
+            if chunked:
+                self._body_chunks = []
+                self._body_size = 0
+                self.stream.read_until("\r\n", self._on_chunk_length)
+            elif consumer is not None:
+                self._body_remaining = content_length
+                self._read_body_chunk()
+            else:
+                self.stream.read_bytes(content_length, self._on_request_body)
             return
 
         self.request_callback(self._request)
 
+    def _overloaded(self):
+        self._request = None
+        self.stream.write("HTTP/1.1 503 Service Unavailable\r\n"
+                          "Retry-After: %d\r\nConnection: close\r\n"
+                          "Content-Length: 0\r\n\r\n" %
+                          self.admission.retry_after, self.stream.close)
+
+    def _on_close(self):
+        # The client went away before we finished its request
+        if self._request is not None:
+            self.admission.release(self._request)
+
+    def _bad_request(self, reason):
+        logging.info("Malformed HTTP request from %s: %s", self.address[0],
+                     reason)
+        if self._body_consumer is not None or self._request_finished:
+            # A handler is already responding, so we can't
+            self.stream.close()
+            return
+        self.stream.write("HTTP/1.1 400 Bad Request\r\nConnection: close"
+                          "\r\nContent-Length: 0\r\n\r\n", self.stream.close)
+
+    def _body_too_large(self, size):
+        logging.warning("Request body too large: %d", size)
+        consumer = self._body_consumer
+        if consumer is not None and not self._request_finished and \
+           hasattr(consumer, "body_too_large"):
+            # The handler is already running, so it has to respond
+            consumer.body_too_large()
+            if self._body_consumer is consumer and \
+               not self._request_finished:
+                self.stream.close()
+            return
+        if consumer is not None or self._request_finished:
+            self.stream.close()
+            return
+        self.stream.write("HTTP/1.1 413 Request Entity Too Large\r\n"
+                          "Connection: close\r\nContent-Length: 0\r\n\r\n",
+                          self.stream.close)
+
+    def _read_body_chunk(self):
+        self.stream.read_bytes(
+            min(self._body_remaining, self._BODY_CHUNK_SIZE),
+            self._on_body_chunk)
+
+    def _on_body_chunk(self, data):
+        consumer = self._body_consumer
+        self._body_remaining -= len(data)
+        if not self._body_remaining:
+            self._body_pending = False
+        consumer.data_received(data)
+        if self._body_consumer is not consumer or self._request_finished:
+            # The response was sent before the whole body arrived
+            return
+        if self._body_remaining:
+            self._read_body_chunk()
+        else:
+            consumer.finish()
+
+    def _on_chunk_length(self, data):
+        # Ignore any chunk extensions after the length
+        try:
+            length = int(data.split(";", 1)[0].strip(), 16)
+            if length < 0:
+                raise ValueError("Negative chunk length")
+        except ValueError, e:
+            self._bad_request(e)
+            return
+        if length == 0:
+            self.stream.read_until("\r\n", self._on_chunk_trailer)
+            return
+        self._body_size += length
+        limit = self._request.max_body_size
+        if (limit is not None and self._body_size > limit) or \
+           (self._body_consumer is None and
+            self._body_size > self.stream.max_buffer_size):
+            self._body_too_large(self._body_size)
+            return
+        self._body_remaining = length
+        self._read_chunk_data()
+
+    def _read_chunk_data(self):
+        # Large chunks are read in pieces so they never have to fit in
+        # the stream's buffer all at once
+        self.stream.read_bytes(
+            min(self._body_remaining, self._BODY_CHUNK_SIZE),
+            self._on_chunk_data)
+
+    def _on_chunk_data(self, data):
+        self._body_remaining -= len(data)
+        consumer = self._body_consumer
+        if consumer is not None:
+            consumer.data_received(data)
+            if self._body_consumer is not consumer or \
+               self._request_finished:
+                return
+        else:
+            self._body_chunks.append(data)
+        if self._body_remaining:
+            self._read_chunk_data()
+        else:
+            self.stream.read_bytes(2, self._on_chunk_end)
+
+    def _on_chunk_end(self, data):
+        if data != "\r\n":
+            self._bad_request("Chunk is longer than its length")
+            return
+        self.stream.read_until("\r\n", self._on_chunk_length)
+
+    def _on_chunk_trailer(self, data):
+        if data != "\r\n":
+            # We don't use trailers, so skip to the empty line ending them
+            self.stream.read_until("\r\n", self._on_chunk_trailer)
+            return
+        self._body_pending = False
+        if self._body_consumer is not None:
+            self._body_consumer.finish()
+        else:
+            body = "".join(self._body_chunks)
+            self._body_chunks = None
+            self._on_request_body(body)
+
     def _on_request_body(self, data):
+        self._body_pending = False
         self._request.body = data
         content_type = self._request.headers.get("Content-Type", "")
         if self._request.method in ("POST", "PUT"):
@@ -292,7 +628,12 @@ class HTTPConnection(object):
                             values)
             elif content_type.startswith("multipart/form-data"):
                 boundary = content_type[30:]
-                if boundary: self._parse_mime_body(boundary, data)
+                if boundary:
+                    try:
+                        self._parse_mime_body(boundary, data)
+                    except ValueError, e:
+                        self._bad_request(e)
+                        return
         self.request_callback(self._request)
 
     def _parse_mime_body(self, boundary, data):
@@ -368,6 +709,8 @@ class HTTPRequest(object):
         self.host = host or headers.get("Host") or "127.0.0.1"
         self.files = files or {}
         self.connection = connection
+        # The largest body we accept, if smaller than the server's limit
+        self.max_body_size = None
         self._start_time = time.time()
         self._finish_time = None
 
@@ -384,10 +727,21 @@ class HTTPRequest(object):
         """Returns True if this request supports HTTP/1.1 semantics"""
         return self.version == "HTTP/1.1"
 
-    def write(self, chunk):
-        """Writes the given chunk to the response stream."""
+    def write(self, chunk, callback=None):
+        """Writes the given chunk to the response stream.
+
+        If callback is given, it is called once the connection is ready
+        for more output. See HTTPConnection.write().
+        """
         assert isinstance(chunk, str)
-        self.connection.write(chunk)
+        self.connection.write(chunk, callback)
+
+    def write_file(self, file, offset, count):
+        """Writes part of an open file to the response stream.
+
+        The connection closes the file once it has been sent.
+        """
+        self.connection.write_file(file, offset, count)
 
     def finish(self):
         """Finishes this HTTP request on the open connection."""
@@ -416,19 +770,68 @@ class HTTPRequest(object):
 class HTTPHeaders(dict):
     """A dictionary that maintains Http-Header-Case for all keys."""
     def __setitem__(self, name, value):
-        dict.__setitem__(self, self._normalize_name(name), value)
+        dict.__setitem__(self, _normalize_header(name), value)
 
     def __getitem__(self, name):
-        return dict.__getitem__(self, self._normalize_name(name))
+        return dict.__getitem__(self, _normalize_header(name))
 
     def _normalize_name(self, name):
-        return "-".join([w.capitalize() for w in name.split("-")])
+        return _normalize_header(name)
 
     @classmethod
     def parse(cls, headers_string):
+        """Parses the header lines of an HTTP message.
+
+        Raises ValueError if a line is malformed.
+        """
         headers = cls()
+        name = None
         for line in headers_string.splitlines():
-            if line:
-                name, value = line.split(": ", 1)
-                headers[name] = value
+            if not line:
+                continue
+            if line[0] in " \t":
+                # A continuation of the previous header's value
+                if name is None:
+                    raise _BadRequestException(
+                        "Header continuation without a header")
+                value = dict.__getitem__(headers, name) + " " + line.strip()
+                dict.__setitem__(headers, name, value)
+                continue
+            name, sep, value = line.partition(":")
+            if not sep:
+                raise _BadRequestException("Malformed header line %r" % line)
+            name = _normalize_header(name)
+            dict.__setitem__(headers, name, value.strip())
         return headers
+
+
+class _BadRequestException(ValueError):
+    """Raised when an HTTP request cannot be parsed."""
+    pass
+
+
+# Normalized names for the headers we see most, so we rarely have to
+# compute them. Other names are cached as they are seen, up to a limit.
+_NORMALIZED_HEADERS = {}
+_NORMALIZED_HEADERS_LIMIT = 1000
+
+
+def _normalize_header(name):
+    try:
+        return _NORMALIZED_HEADERS[name]
+    except KeyError:
+        normalized = "-".join([w.capitalize() for w in name.split("-")])
+        if len(_NORMALIZED_HEADERS) < _NORMALIZED_HEADERS_LIMIT:
+            _NORMALIZED_HEADERS[name] = normalized
+        return normalized
+
+
+for _name in ("Accept", "Accept-Charset", "Accept-Encoding", "Accept-Language",
+              "Authorization", "Cache-Control", "Connection", "Content-Length",
+              "Content-Type", "Cookie", "Expect", "Host", "If-Modified-Since",
+              "If-None-Match", "Keep-Alive", "Pragma", "Range", "Referer",
+              "Transfer-Encoding", "User-Agent", "X-Forwarded-For",
+              "X-Real-Ip", "X-Requested-With", "X-Scheme"):
+    _NORMALIZED_HEADERS[_name] = _name
+    _NORMALIZED_HEADERS[_name.lower()] = _name
+del _name
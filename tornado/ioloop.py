@@ -16,12 +16,16 @@
 
 """A level-triggered I/O loop for non-blocking sockets."""
 
-import bisect
+import collections
 import errno
 import fcntl
+import functools
+import heapq
+import itertools
 import logging
 import os
 import select
+import threading
 import time
 
 
@@ -79,13 +83,38 @@ class IOLoop(object):
     WRITE = _EPOLLOUT
     ERROR = _EPOLLERR | _EPOLLHUP | _EPOLLRDHUP
 
+    # Only report events when the state of the fd changes. Only supported
+    # by the epoll implementations; see supports_edge_triggered()
+    EDGE = _EPOLLET
+
+    # How long to wait in poll() when there are no timeouts. The waker
+    # pipe interrupts the wait when callbacks are added or stop() is called
+    _MAX_POLL_TIMEOUT = 3600.0
+
+    # A poll() returning sooner than this found events already waiting
+    _QUEUED_POLL_TIME = 0.0005
+
+    # Rebuild the timeout heap once more than this many cancelled timeouts
+    # (and more than half of the heap) are waiting to be discarded
+    _COMPACT_THRESHOLD = 512
+
     def __init__(self, impl=None):
         self._impl = impl or _poll()
         self._handlers = {}
         self._events = {}
-        self._callbacks = set()
+        self._callbacks = collections.deque()
+        self._running_callbacks = None
+        self._callback_lock = threading.Lock()
         self._timeouts = []
+        self._cancellations = 0
         self._running = False
+        self._stats = {}
+        self.reset_stats()
+        self._last_poll_end = self._ready_since = time.time()
+
+        # If set, callbacks and handlers that run longer than this many
+        # seconds are logged along with their names
+        self.slow_callback_threshold = None
 
         # Create a pipe that we send bogus data to when we want to wake
         # the I/O loop when it is idle
@@ -94,7 +123,7 @@ class IOLoop(object):
         self._set_nonblocking(w)
         self._waker_reader = os.fdopen(r, "r", 0)
         self._waker_writer = os.fdopen(w, "w", 0)
-        self.add_handler(r, self._read_waker, self.WRITE)
+        self.add_handler(r, self._read_waker, self.READ)
 
     @classmethod
     def instance(cls):
@@ -125,6 +154,10 @@ class IOLoop(object):
         self._handlers[fd] = handler
         self._impl.register(fd, events | self.ERROR)
 
+    def supports_edge_triggered(self):
+        """Returns True if handlers can be registered with the EDGE flag."""
+        return not isinstance(self._impl, _Select)
+
     def update_handler(self, fd, events):
         """Changes the events we listen for fd."""
         self._impl.modify(fd, events | self.ERROR)
@@ -146,33 +179,52 @@ class IOLoop(object):
         """
         self._running = True
         while True:
-            # Never use an infinite timeout here - it can stall epoll
-            poll_timeout = 0.2
+            iteration_start = time.time()
+
+            # Sleep until the next timeout or until we are woken up
+            poll_timeout = self._MAX_POLL_TIMEOUT
 
             # Prevent IO event starvation by delaying new callbacks
             # to the next iteration of the event loop.
-            callbacks = list(self._callbacks)
-            for callback in callbacks:
-                # A callback can add or remove other callbacks
-                if callback in self._callbacks:
-                    self._callbacks.remove(callback)
-                    self._run_callback(callback)
+            self._callback_lock.acquire()
+            try:
+                callbacks = self._callbacks
+                self._callbacks = collections.deque()
+            finally:
+                self._callback_lock.release()
+            # A callback can add or remove other callbacks
+            self._running_callbacks = callbacks
+            while callbacks:
+                self._run_callback(callbacks.popleft())
+            self._running_callbacks = None
 
             if self._callbacks:
                 poll_timeout = 0.0
 
             if self._timeouts:
                 now = time.time()
-                while self._timeouts and self._timeouts[0].deadline <= now:
-                    timeout = self._timeouts.pop(0)
-                    self._run_callback(timeout.callback)
-                if self._timeouts:
-                    milliseconds = self._timeouts[0].deadline - now
-                    poll_timeout = min(milliseconds, poll_timeout)
+                while self._timeouts:
+                    if self._timeouts[0].callback is None:
+                        # The timeout was cancelled
+                        heapq.heappop(self._timeouts)
+                        self._cancellations -= 1
+                    elif self._timeouts[0].deadline <= now:
+                        timeout = heapq.heappop(self._timeouts)
+                        callback = timeout.callback
+                        timeout.callback = None
+                        self._run_callback(callback)
+                    else:
+                        milliseconds = self._timeouts[0].deadline - now
+                        poll_timeout = min(milliseconds, poll_timeout)
+                        break
+                if (self._cancellations > self._COMPACT_THRESHOLD and
+                    self._cancellations > len(self._timeouts) >> 1):
+                    self._compact_timeouts()
 
             if not self._running:
                 break
 
+            poll_start = time.time()
             try:
                 event_pairs = self._impl.poll(poll_timeout)
             except Exception, e:
@@ -181,6 +233,14 @@ class IOLoop(object):
                     continue
                 else:
                     raise
+            poll_end = time.time()
+            if poll_end - poll_start < self._QUEUED_POLL_TIME:
+                # The events were already waiting, since some time while
+                # the last iteration ran
+                self._ready_since = self._last_poll_end
+            else:
+                self._ready_since = poll_end
+            self._last_poll_end = poll_end
 
             # Pop one fd at a time from the set of pending fds and run
             # its handler. Since that handler may perform actions on
@@ -189,6 +249,8 @@ class IOLoop(object):
             self._events.update(event_pairs)
             while self._events:
                 fd, events = self._events.popitem()
+                handler = self._handlers.get(fd)
+                handler_start = time.time()
                 try:
                     self._handlers[fd](fd, events)
                 except KeyboardInterrupt:
@@ -203,6 +265,10 @@ class IOLoop(object):
                 except:
                     logging.error("Exception in I/O handler for fd %d",
                                   fd, exc_info=True)
+                self._check_slow(handler, time.time() - handler_start)
+
+            self._record_iteration(iteration_start, poll_start, poll_end,
+                                   time.time())
 
     def stop(self):
         """Stop the loop after the current event loop iteration is complete."""
@@ -216,20 +282,81 @@ class IOLoop(object):
     def add_timeout(self, deadline, callback):
         """Calls the given callback at the time deadline from the I/O loop."""
         timeout = _Timeout(deadline, callback)
-        bisect.insort(self._timeouts, timeout)
+        heapq.heappush(self._timeouts, timeout)
         return timeout
 
     def remove_timeout(self, timeout):
-        self._timeouts.remove(timeout)
+        """Cancels a pending timeout.
+
+        Removing an item from the middle of the heap is expensive, so we
+        just clear its callback. Cancelled timeouts are discarded when
+        they reach the top of the heap, or all at once by
+        _compact_timeouts() once they make up most of the heap.
+        """
+        if timeout.callback is not None:
+            timeout.callback = None
+            self._cancellations += 1
 
     def add_callback(self, callback):
-        """Calls the given callback on the next I/O loop iteration."""
-        self._callbacks.add(callback)
-        self._wake()
+        """Calls the given callback on the next I/O loop iteration.
+
+        Callbacks run in the order they were added. It is safe to call
+        this method from other threads. We only wake the I/O loop for the
+        first callback added since the last iteration.
+        """
+        self._callback_lock.acquire()
+        try:
+            wake = not self._callbacks
+            self._callbacks.append(callback)
+        finally:
+            self._callback_lock.release()
+        if wake:
+            self._wake()
 
     def remove_callback(self, callback):
         """Removes the given callback from the next I/O loop iteration."""
-        self._callbacks.remove(callback)
+        self._callback_lock.acquire()
+        try:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+                return
+        finally:
+            self._callback_lock.release()
+        if self._running_callbacks:
+            self._running_callbacks.remove(callback)
+        else:
+            raise ValueError("Callback %r is not scheduled" % callback)
+
+    def queue_delay(self):
+        """Returns how long the events being handled may have waited.
+
+        If poll() found events waiting, they may have arrived just after
+        the previous poll() returned, so this is at most the time since
+        then. It grows when handlers block the loop, and is a measure of
+        how far behind we are.
+        """
+        return time.time() - self._ready_since
+
+    def stats(self):
+        """Returns a dictionary of timings for this I/O loop.
+
+        All times are totals in seconds since the last reset_stats() call:
+
+            iterations: number of completed loop iterations
+            callback_time: time spent running callbacks and timeouts
+            poll_time: time spent waiting for events in poll()
+            handler_time: time spent in I/O handlers
+            max_iteration_time: longest iteration, excluding poll()
+            slow_callbacks: callbacks and handlers that exceeded
+                slow_callback_threshold
+        """
+        return dict(self._stats)
+
+    def reset_stats(self):
+        """Resets the timings returned by stats()."""
+        self._stats.update(iterations=0, callback_time=0.0, poll_time=0.0,
+                           handler_time=0.0, max_iteration_time=0.0,
+                           slow_callbacks=0)
 
     def _wake(self):
         try:
@@ -238,12 +365,31 @@ class IOLoop(object):
             pass
 
     def _run_callback(self, callback):
+        start = time.time()
         try:
             callback()
         except (KeyboardInterrupt, SystemExit):
             raise
         except:
             logging.error("Exception in callback %r", callback, exc_info=True)
+        self._check_slow(callback, time.time() - start)
+
+    def _check_slow(self, callback, duration):
+        threshold = self.slow_callback_threshold
+        if threshold is not None and duration >= threshold:
+            self._stats["slow_callbacks"] += 1
+            logging.warning("Slow callback %s blocked the I/O loop for %.2fms",
+                            _callback_name(callback), duration * 1000.0)
+
+    def _record_iteration(self, start, poll_start, poll_end, end):
+        stats = self._stats
+        busy_time = (poll_start - start) + (end - poll_end)
+        stats["iterations"] += 1
+        stats["callback_time"] += poll_start - start
+        stats["poll_time"] += poll_end - poll_start
+        stats["handler_time"] += end - poll_end
+        if busy_time > stats["max_iteration_time"]:
+            stats["max_iteration_time"] = busy_time
 
     def _read_waker(self, fd, events):
         try:
@@ -252,20 +398,52 @@ class IOLoop(object):
         except IOError:
             pass
 
+    def _compact_timeouts(self):
+        self._timeouts = [t for t in self._timeouts if t.callback is not None]
+        heapq.heapify(self._timeouts)
+        self._cancellations = 0
+
     def _set_nonblocking(self, fd):
         flags = fcntl.fcntl(fd, fcntl.F_GETFL)
         fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
 
 
+def _callback_name(callback):
+    """Returns a readable name for a callback or handler for logging."""
+    while isinstance(callback, functools.partial):
+        callback = callback.func
+    name = getattr(callback, "__name__", None)
+    if name is None:
+        return repr(callback)
+    owner = getattr(callback, "im_self", None)
+    if owner is not None:
+        name = owner.__class__.__name__ + "." + name
+    module = getattr(callback, "__module__", None)
+    if module:
+        name = module + "." + name
+    return name
+
+
 class _Timeout(object):
     """An IOLoop timeout, a UNIX timestamp and a callback"""
+    __slots__ = ("deadline", "callback", "_sequence")
+
+    # Breaks ties between equal deadlines so timeouts run in the order
+    # they were added
+    _sequence_counter = itertools.count()
+
     def __init__(self, deadline, callback):
         self.deadline = deadline
         self.callback = callback
+        self._sequence = self._sequence_counter.next()
+
+    def __lt__(self, other):
+        return ((self.deadline, self._sequence) <
+                (other.deadline, other._sequence))
 
-    def __cmp__(self, other):
-        return cmp((self.deadline, id(self.callback)),
-                   (other.deadline, id(other.callback)))
+    def __le__(self, other):
+        return ((self.deadline, self._sequence) <=
+                (other.deadline, other._sequence))
 
 
 class PeriodicCallback(object):
@@ -301,8 +479,9 @@ class _EPoll(object):
     _EPOLL_CTL_DEL = 2
     _EPOLL_CTL_MOD = 3
 
-    def __init__(self):
+    def __init__(self, max_events=1024):
         self._epoll_fd = epoll.epoll_create()
+        self.max_events = max_events
 
     def register(self, fd, events):
         epoll.epoll_ctl(self._epoll_fd, self._EPOLL_CTL_ADD, fd, events)
@@ -314,7 +493,8 @@ class _EPoll(object):
         epoll.epoll_ctl(self._epoll_fd, self._EPOLL_CTL_DEL, fd, 0)
 
     def poll(self, timeout):
-        return epoll.epoll_wait(self._epoll_fd, int(timeout * 1000))
+        return epoll.epoll_wait(self._epoll_fd, int(timeout * 1000),
+                                self.max_events)
 
 
 class _Select(object):
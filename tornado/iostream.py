@@ -16,11 +16,32 @@
 
 """A utility class to write to and read from a non-blocking socket."""
 
+import collections
 import errno
 import ioloop
 import logging
+import mmap
+import os
 import socket
 
+try:
+    import ssl # Python 2.6+
+except ImportError:
+    ssl = None
+
+# Queued buffers smaller than this are joined before sending, so many
+# small writes don't each cost a system call
+_WRITE_COALESCE_SIZE = 65536
+
+# The most buffers we pass to a single sendmsg() call
+_MAX_IOV = 64
+
+# The most file data we send (or map into memory) in one system call
+_FILE_CHUNK_SIZE = 1048576
+
+# os.sendfile is only available on Python 3.3+
+_sendfile = getattr(os, "sendfile", None)
+
 
 class IOStream(object):
     """A utility class to write to and read from a non-blocking socket.
@@ -60,27 +81,73 @@ class IOStream(object):
 
     """
     def __init__(self, socket, io_loop=None, max_buffer_size=104857600,
-                 read_chunk_size=4096):
+                 read_chunk_size=4096, edge_triggered=False,
+                 max_read_chunk_size=262144, write_high_water_mark=1048576,
+                 write_low_water_mark=262144):
+        """Wraps the given non-blocking socket.
+
+        If edge_triggered is True and the IOLoop supports it, we register
+        the socket for reads and writes once and drain it on every event
+        instead of updating the events we listen for on each read and
+        write.
+
+        Each recv() starts at read_chunk_size bytes. The size doubles, up
+        to max_read_chunk_size, while reads keep filling it and shrinks
+        back when they don't.
+
+        Writers that produce a lot of output should stop writing once
+        write_buffer_full() returns True, meaning more than
+        write_high_water_mark bytes are waiting to be sent, and resume
+        from a set_drain_callback() callback, which runs once no more
+        than write_low_water_mark bytes are left.
+        """
         self.socket = socket
         self.socket.setblocking(False)
         self.io_loop = io_loop or ioloop.IOLoop.instance()
         self.max_buffer_size = max_buffer_size
         self.read_chunk_size = read_chunk_size
-        self._read_buffer = ""
-        self._write_buffer = ""
+        self.max_read_chunk_size = max(max_read_chunk_size, read_chunk_size)
+        self._edge_triggered = edge_triggered and \
+            self.io_loop.supports_edge_triggered()
+        # Received data lives in _read_buffer starting at _read_buffer_pos;
+        # consumed data is only discarded once it makes up half the buffer.
+        # _read_scan_pos is where the next delimiter search should start.
+        self._read_buffer = bytearray()
+        self._read_buffer_pos = 0
+        self._read_scan_pos = 0
+        self._recv_buffer = bytearray(read_chunk_size)
+        # Outgoing data is a queue of the buffers given to write(). Partial
+        # sends advance _write_buffer_offset into the first buffer rather
+        # than copying what is left of it.
+        self.write_high_water_mark = write_high_water_mark
+        self.write_low_water_mark = write_low_water_mark
+        self._write_buffer = collections.deque()
+        self._write_buffer_offset = 0
+        self._write_buffer_size = 0
+        self._bytes_queued = 0
+        self._bytes_written = 0
+        self._write_callbacks = collections.deque()
+        self._drain_callback = None
+        self._sendmsg = getattr(socket, "sendmsg", None)
+        # sendfile() bypasses the SSL layer, so only use it on plain sockets
+        self._use_sendfile = _sendfile is not None and \
+            (ssl is None or not isinstance(socket, ssl.SSLSocket))
         self._read_delimiter = None
         self._read_bytes = None
         self._read_callback = None
-        self._write_callback = None
         self._close_callback = None
         self._state = self.io_loop.ERROR
+        if self._edge_triggered:
+            self._state |= self.io_loop.READ | self.io_loop.WRITE | \
+                self.io_loop.EDGE
         self.io_loop.add_handler(
             self.socket.fileno(), self._handle_events, self._state)
 
     def read_until(self, delimiter, callback):
         """Call callback when we read the given delimiter."""
         assert not self._read_callback, "Already reading"
-        loc = self._read_buffer.find(delimiter)
+        self._read_scan_pos = self._read_buffer_pos
+        loc = self._find_delimiter(delimiter)
         if loc != -1:
             callback(self._consume(loc + len(delimiter)))
             return
@@ -92,7 +159,7 @@ class IOStream(object):
     def read_bytes(self, num_bytes, callback):
         """Call callback when we read the given number of bytes."""
         assert not self._read_callback, "Already reading"
-        if len(self._read_buffer) >= num_bytes:
+        if self._buffered() >= num_bytes:
             callback(self._consume(num_bytes))
             return
         self._check_closed()
@@ -103,15 +170,60 @@ class IOStream(object):
     def write(self, data, callback=None):
         """Write the given data to this stream.
 
-        If callback is given, we call it when all of the buffered write
-        data has been successfully written to the stream. If there was
-        previously buffered write data and an old write callback, that
-        callback is simply overwritten with this new callback.
+        If callback is given, we call it when this data has been
+        successfully written to the stream. Callbacks for earlier writes
+        are kept and run in order as their data is written.
+        """
+        self._check_closed()
+        self._queue_write(data, callback)
+
+    def write_file(self, file, offset, count, callback=None):
+        """Write count bytes of the given file, starting at offset.
+
+        The file is sent with sendfile() where possible, or else from
+        memory mapped chunks, so it is never read into memory as a whole.
+        The stream takes ownership of the file and closes it when the
+        data has been sent or the stream is closed. The callback works
+        as it does for write().
         """
         self._check_closed()
-        self._write_buffer += data
-        self._add_io_state(self.io_loop.WRITE)
-        self._write_callback = callback
+        if count:
+            self._queue_write(_FileRegion(file, offset, count), callback)
+        else:
+            file.close()
+            self._queue_write("", callback)
+
+    def _queue_write(self, data, callback):
+        if data:
+            self._write_buffer.append(data)
+            self._write_buffer_size += len(data)
+            self._bytes_queued += len(data)
+        if callback is not None:
+            self._write_callbacks.append((self._bytes_queued, callback))
+        if self._edge_triggered:
+            # We won't get another event if the socket is already
+            # writable, so start writing on the next loop iteration
+            self.io_loop.add_callback(self._handle_write)
+        else:
+            self._add_io_state(self.io_loop.WRITE)
+
+    def write_buffer_full(self):
+        """Returns True if more than write_high_water_mark bytes are queued.
+        """
+        return self._write_buffer_size > self.write_high_water_mark
+
+    def set_drain_callback(self, callback):
+        """Call the given callback once the write buffer has drained.
+
+        The callback runs when no more than write_low_water_mark bytes are
+        waiting to be written, or on the next I/O loop iteration if that is
+        already the case. Setting a new callback replaces the old one.
+        """
+        if self._write_buffer_size <= self.write_low_water_mark:
+            self._drain_callback = None
+            self.io_loop.add_callback(callback)
+        else:
+            self._drain_callback = callback
 
     def set_close_callback(self, callback):
         """Call the given callback when the stream is closed."""
@@ -120,6 +232,9 @@ class IOStream(object):
     def close(self):
         """Close this stream."""
         if self.socket is not None:
+            for data in self._write_buffer:
+                if isinstance(data, _FileRegion):
+                    data.file.close()
             self.io_loop.remove_handler(self.socket.fileno())
             self.socket.close()
             self.socket = None
@@ -131,7 +246,7 @@ class IOStream(object):
 
     def writing(self):
         """Returns true if we are currently writing to the stream."""
-        return len(self._write_buffer) > 0
+        return self._write_buffer_size > 0
 
     def closed(self):
         return self.socket is None
@@ -151,6 +266,8 @@ class IOStream(object):
         if events & self.io_loop.ERROR:
             self.close()
             return
+        if self._edge_triggered:
+            return
         state = self.io_loop.ERROR
         if self._read_delimiter or self._read_bytes:
             state |= self.io_loop.READ
@@ -161,33 +278,58 @@ class IOStream(object):
             self.io_loop.update_handler(self.socket.fileno(), self._state)
 
     def _handle_read(self):
-        try:
-            chunk = self.socket.recv(self.read_chunk_size)
-        except socket.error, e:
-            if e[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
-                return
-            else:
-                logging.warning("Read error on %d: %s",
-                                self.socket.fileno(), e)
+        # In edge-triggered mode we must read until the socket would
+        # block, since we will not be told about data we leave behind
+        eof = False
+        while True:
+            try:
+                num_bytes = self.socket.recv_into(self._recv_buffer)
+            except socket.error, e:
+                if e[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                    break
+                else:
+                    logging.warning("Read error on %d: %s",
+                                    self.socket.fileno(), e)
+                    self.close()
+                    return
+            if not num_bytes:
+                eof = True
+                break
+            self._read_buffer += memoryview(self._recv_buffer)[:num_bytes]
+            self._adapt_read_size(num_bytes)
+            if self._buffered() >= self.max_buffer_size:
+                logging.error("Reached maximum read buffer size")
                 self.close()
                 return
-        if not chunk:
+            if not self._edge_triggered:
+                break
+        if eof and not self._edge_triggered:
             self.close()
             return
-        self._read_buffer += chunk
-        if len(self._read_buffer) >= self.max_buffer_size:
-            logging.error("Reached maximum read buffer size")
+        self._run_read_callback()
+        if eof:
             self.close()
+
+    def _adapt_read_size(self, num_bytes):
+        size = len(self._recv_buffer)
+        if num_bytes == size and size < self.max_read_chunk_size:
+            size = min(size * 2, self.max_read_chunk_size)
+        elif num_bytes < size // 4 and size > self.read_chunk_size:
+            size = max(size // 2, self.read_chunk_size)
+        else:
             return
+        self._recv_buffer = bytearray(size)
+
+    def _run_read_callback(self):
         if self._read_bytes:
-            if len(self._read_buffer) >= self._read_bytes:
+            if self._buffered() >= self._read_bytes:
                 num_bytes = self._read_bytes
                 callback = self._read_callback
                 self._read_callback = None
                 self._read_bytes = None
                 callback(self._consume(num_bytes))
         elif self._read_delimiter:
-            loc = self._read_buffer.find(self._read_delimiter)
+            loc = self._find_delimiter(self._read_delimiter)
             if loc != -1:
                 callback = self._read_callback
                 delimiter_len = len(self._read_delimiter)
@@ -196,11 +338,12 @@ class IOStream(object):
                 callback(self._consume(loc + delimiter_len))
 
     def _handle_write(self):
+        if not self.socket:
+            return
         while self._write_buffer:
             try:
-                num_bytes = self.socket.send(self._write_buffer)
-                self._write_buffer = self._write_buffer[num_bytes:]
-            except socket.error, e:
+                num_bytes = self._send_buffers()
+            except (socket.error, OSError), e:
                 if e[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
                     break
                 else:
@@ -208,14 +351,103 @@ class IOStream(object):
                                     self.socket.fileno(), e)
                     self.close()
                     return
-        if not self._write_buffer and self._write_callback:
-            callback = self._write_callback
-            self._write_callback = None
+            self._advance_write_buffer(num_bytes)
+        while self._write_callbacks and \
+              self._write_callbacks[0][0] <= self._bytes_written:
+            callback = self._write_callbacks.popleft()[1]
+            callback()
+        if self._drain_callback and \
+           self._write_buffer_size <= self.write_low_water_mark:
+            callback = self._drain_callback
+            self._drain_callback = None
             callback()
 
+    def _send_buffers(self):
+        buffers = self._write_buffer
+        offset = self._write_buffer_offset
+        if isinstance(buffers[0], _FileRegion):
+            return self._send_file_region(buffers[0], offset)
+        if self._sendmsg is not None and len(buffers) > 1:
+            iov = [memoryview(buffers[0])[offset:]]
+            for i in xrange(1, min(len(buffers), _MAX_IOV)):
+                if isinstance(buffers[i], _FileRegion):
+                    break
+                iov.append(buffers[i])
+            return self._sendmsg(iov)
+        if len(buffers) > 1 and len(buffers[0]) < _WRITE_COALESCE_SIZE:
+            # Join the small buffers at the front of the queue
+            pieces = [buffers.popleft()[offset:]]
+            size = len(pieces[0])
+            while buffers and not isinstance(buffers[0], _FileRegion) and \
+                  size + len(buffers[0]) <= _WRITE_COALESCE_SIZE:
+                pieces.append(buffers.popleft())
+                size += len(pieces[-1])
+            buffers.appendleft("".join(pieces))
+            self._write_buffer_offset = offset = 0
+        if offset:
+            return self.socket.send(memoryview(buffers[0])[offset:])
+        return self.socket.send(buffers[0])
+
+    def _send_file_region(self, region, position):
+        offset = region.offset + position
+        count = min(region.count - position, _FILE_CHUNK_SIZE)
+        if self._use_sendfile:
+            return _sendfile(self.socket.fileno(), region.file.fileno(),
+                             offset, count)
+        # Map only the part of the file we are about to send. The mapping
+        # has to start on an allocation boundary.
+        start = offset - offset % mmap.ALLOCATIONGRANULARITY
+        chunk = mmap.mmap(region.file.fileno(), offset - start + count,
+                          access=mmap.ACCESS_READ, offset=start)
+        try:
+            return self.socket.send(buffer(chunk, offset - start, count))
+        finally:
+            chunk.close()
+
+    def _advance_write_buffer(self, num_bytes):
+        self._write_buffer_size -= num_bytes
+        self._bytes_written += num_bytes
+        buffers = self._write_buffer
+        while num_bytes:
+            remaining = len(buffers[0]) - self._write_buffer_offset
+            if num_bytes < remaining:
+                self._write_buffer_offset += num_bytes
+                return
+            num_bytes -= remaining
+            data = buffers.popleft()
+            if isinstance(data, _FileRegion):
+                data.file.close()
+            self._write_buffer_offset = 0
+
+    def _buffered(self):
+        return len(self._read_buffer) - self._read_buffer_pos
+
+    def _find_delimiter(self, delimiter):
+        """Returns the offset of delimiter in the unconsumed data, or -1.
+
+        We remember where a failed search stopped, so each new chunk is
+        only scanned once (plus enough overlap for a split delimiter).
+        """
+        start = max(self._read_scan_pos, self._read_buffer_pos)
+        loc = self._read_buffer.find(delimiter, start)
+        if loc == -1:
+            self._read_scan_pos = max(
+                start, len(self._read_buffer) - len(delimiter) + 1)
+            return -1
+        return loc - self._read_buffer_pos
+
     def _consume(self, loc):
-        result = self._read_buffer[:loc]
-        self._read_buffer = self._read_buffer[loc:]
+        pos = self._read_buffer_pos
+        result = str(self._read_buffer[pos:pos + loc])
+        pos += loc
+        if pos >= len(self._read_buffer):
+            self._read_buffer = bytearray()
+            pos = 0
+        elif pos > len(self._read_buffer) // 2:
+            del self._read_buffer[:pos]
+            pos = 0
+        self._read_buffer_pos = pos
+        self._read_scan_pos = pos
         return result
 
     def _check_closed(self):
@@ -226,3 +458,14 @@ class IOStream(object):
         if not self._state & state:
             self._state = self._state | state
             self.io_loop.update_handler(self.socket.fileno(), self._state)
+
+
+class _FileRegion(object):
+    """A range of an open file waiting in an IOStream write buffer."""
+    def __init__(self, file, offset, count):
+        self.file = file
+        self.offset = offset
+        self.count = count
+
+    def __len__(self):
+        return self.count
@@ -210,7 +210,10 @@ class BucketHandler(BaseRequestHandler):
 
 
 class ObjectHandler(BaseRequestHandler):
-    def get(self, bucket, object_name):
+    def head(self, bucket, object_name):
+        self.get(bucket, object_name, include_body=False)
+
+    def get(self, bucket, object_name, include_body=True):
         object_name = urllib.unquote(object_name)
         path = self._object_path(bucket, object_name)
         if not path.startswith(self.application.directory) or \
@@ -220,11 +223,7 @@ class ObjectHandler(BaseRequestHandler):
         self.set_header("Content-Type", "application/unknown")
         self.set_header("Last-Modified", datetime.datetime.utcfromtimestamp(
             info.st_mtime))
-        object_file = open(path, "r")
-        try:
-            self.finish(object_file.read())
-        finally:
-            object_file.close()
+        self.send_file(path, include_body)
 
     def put(self, bucket, object_name):
         object_name = urllib.unquote(object_name)
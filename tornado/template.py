@@ -21,12 +21,23 @@ Basic usage looks like:
     t = template.Template("<html>{{ myvalue }}</html>")
     print t.generate(myvalue="XXX")
 
+generate_stream() returns an iterator over the output in pieces instead,
+for pages large enough that they should start going out to the client
+before they are done rendering.
+
 Loader is a class that loads templates from a root directory and caches
 the compiled templates:
 
     loader = template.Loader("/home/btaylor")
     print loader.load("test.html").generate(myvalue="XXX")
 
+Loader can also save compiled templates in a directory so other processes
+don't need to compile them again, and can check for modified templates
+while you are developing:
+
+    loader = template.Loader("/home/btaylor", cache_directory="/tmp/tc",
+                             check_mtime=True)
+
 We compile all templates to raw Python. Error-reporting is currently... uh,
 interesting. Syntax for the templates
 
@@ -81,39 +92,107 @@ to all templates by default.
 
 from __future__ import with_statement
 
+import __builtin__
 import cStringIO
 import datetime
 import escape
+import hashlib
+import imp
 import logging
+import marshal
+import os
 import os.path
 import re
+import types
 
 
 class Template(object):
     """A compiled template.
 
     We compile into Python from the given template_string. You can generate
-    the template from variables with generate().
+    the template from variables with generate(). Loader passes in code it
+    compiled earlier as compiled, a (code, code object) tuple, in which
+    case we only parse the template if another template needs it.
     """
     def __init__(self, template_string, name="<string>", loader=None,
-                 compress_whitespace=None):
+                 compress_whitespace=None, compiled=None):
         self.name = name
         if compress_whitespace is None:
             compress_whitespace = name.endswith(".html") or \
                 name.endswith(".js")
-        reader = _TemplateReader(name, template_string)
-        self.file = _File(_parse(reader))
-        self.code = self._generate_python(loader, compress_whitespace)
+        self._template_string = template_string
+        self._file = None
+        if compiled is None:
+            self.code = self._generate_python(loader, compress_whitespace)
+            self.compiled = self._compile(self.code)
+        else:
+            self.code, self.compiled = compiled
+        self._execute_code = self._function_code(self.compiled)
+        self._loader = loader
+        self._compress_whitespace = compress_whitespace
+        self._stream_source = None
+        self._stream_code = None
+
+    @property
+    def file(self):
+        if self._file is None:
+            reader = _TemplateReader(self.name, self._template_string)
+            self._file = _File(_parse(reader))
+        return self._file
+
+    def generate(self, **kwargs):
+        """Generate this template with the given arguments."""
+        execute = types.FunctionType(self._execute_code,
+                                     self._namespace(kwargs))
         try:
-            self.compiled = compile(self.code, self.name, "exec")
+            return execute()
         except:
             formatted_code = _format_code(self.code).rstrip()
             logging.error("%s code:\n%s", self.name, formatted_code)
             raise
 
-    def generate(self, **kwargs):
-        """Generate this template with the given arguments."""
+    def generate_stream(self, **kwargs):
+        """Generate this template in pieces, returning an iterator.
+
+        Concatenating the pieces gives the same output as generate().
+        The template is compiled for streaming the first time this is used.
+        """
+        if self._stream_code is None:
+            code = self._generate_python(
+                self._loader, self._compress_whitespace, streaming=True)
+            self._stream_code = self._function_code(self._compile(code))
+            self._stream_source = code
+        chunks = types.FunctionType(self._stream_code,
+                                    self._namespace(kwargs))()
+        while True:
+            try:
+                chunk = chunks.next()
+            except StopIteration:
+                return
+            except:
+                formatted_code = _format_code(self._stream_source).rstrip()
+                logging.error("%s code:\n%s", self.name, formatted_code)
+                raise
+            yield chunk
+
+    def _compile(self, code):
+        try:
+            return compile(code, self.name, "exec")
+        except:
+            formatted_code = _format_code(code).rstrip()
+            logging.error("%s code:\n%s", self.name, formatted_code)
+            raise
+
+    def _function_code(self, compiled):
+        # The compiled module only defines one function. We run it once and
+        # keep the function's code, so each render just binds a namespace.
+        namespace = {}
+        exec compiled in namespace
+        return namespace["_execute"].func_code
+
+    def _namespace(self, kwargs):
         namespace = {
+            "__builtins__": __builtin__,
             "escape": escape.xhtml_escape,
             "url_escape": escape.url_escape,
             "json_encode": escape.json_encode,
@@ -121,16 +200,9 @@ class Template(object):
             "datetime": datetime,
         }
         namespace.update(kwargs)
-        exec self.compiled in namespace
-        execute = namespace["_execute"]
-        try:
-            return execute()
-        except:
-            formatted_code = _format_code(self.code).rstrip()
-            logging.error("%s code:\n%s", self.name, formatted_code)
-            raise
+        return namespace
 
-    def _generate_python(self, loader, compress_whitespace):
+    def _generate_python(self, loader, compress_whitespace, streaming=False):
         buffer = cStringIO.StringIO()
         try:
             named_blocks = {}
@@ -140,7 +212,7 @@ class Template(object):
                 ancestor.find_named_blocks(loader, named_blocks)
             self.file.find_named_blocks(loader, named_blocks)
             writer = _CodeWriter(buffer, named_blocks, loader, self,
-                                 compress_whitespace)
+                                 compress_whitespace, streaming)
             ancestors[0].generate(writer)
             return buffer.getvalue()
         finally:
@@ -164,10 +236,21 @@ class Loader(object):
     You must use a template loader to use template constructs like
     {% extends %} and {% include %}. Loader caches all templates after
     they are loaded the first time.
+
+    If cache_directory is given, we also save compiled templates there,
+    and load them from there as long as none of the files they were
+    compiled from (the template and everything it extends or includes)
+    have been modified. If check_mtime is True, load() recompiles
+    templates whose files have been modified since they were loaded.
     """
-    def __init__(self, root_directory):
+    def __init__(self, root_directory, cache_directory=None,
+                 check_mtime=False):
         self.root = os.path.abspath(root_directory)
+        self.cache_directory = cache_directory
+        self.check_mtime = check_mtime
         self.templates = {}
+        self._dependencies = {}
+        self._loading = []
 
     def load(self, name, parent_path=None):
         if parent_path and not parent_path.startswith("<") and \
@@ -178,13 +261,126 @@ class Loader(object):
             relative_path = os.path.abspath(os.path.join(file_dir, name))
             if relative_path.startswith(self.root):
                 name = relative_path[len(self.root) + 1:]
-        if name not in self.templates:
-            path = os.path.join(self.root, name)
-            f = open(path, "r")
-            self.templates[name] = Template(f.read(), name=name, loader=self)
-            f.close()
+        if self._loading:
+            self._loading[-1].add(name)
+        if name not in self.templates or \
+           (self.check_mtime and self._modified(name)):
+            self._load(name)
         return self.templates[name]
 
+    # The file name extensions preload() loads by default
+    TEMPLATE_EXTENSIONS = (".html", ".htm", ".xml", ".txt", ".js", ".css")
+
+    def preload(self, extensions=None):
+        """Loads every template under our root directory.
+
+        Call this before forking worker processes, so the children share
+        the compiled templates rather than each compiling them again.
+        Only files ending in one of the given extensions are loaded,
+        TEMPLATE_EXTENSIONS by default. Files that fail to load are logged
+        and skipped.
+        """
+        extensions = tuple(extensions or self.TEMPLATE_EXTENSIONS)
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+            for filename in filenames:
+                if filename.startswith(".") or \
+                   not filename.endswith(extensions):
+                    continue
+                name = os.path.join(dirpath, filename)[len(self.root) + 1:]
+                try:
+                    self.load(name)
+                except Exception:
+                    logging.warning("Could not preload template %s", name,
+                                    exc_info=True)
+
+    def _load(self, name):
+        path = os.path.join(self.root, name)
+        mtime = os.stat(path).st_mtime
+        f = open(path, "r")
+        try:
+            template_string = f.read()
+        finally:
+            f.close()
+        cached = self._read_cache(name)
+        if cached:
+            dependencies, code, compiled = cached
+            template = Template(template_string, name=name, loader=self,
+                                compiled=(code, compiled))
+        else:
+            # Record the templates this one extends or includes, since
+            # its compiled code depends on them too
+            loaded = set()
+            self._loading.append(loaded)
+            try:
+                template = Template(template_string, name=name, loader=self)
+            finally:
+                self._loading.pop()
+            dependencies = {name: mtime}
+            for dependency in loaded:
+                dependencies.update(self._dependencies[dependency])
+            self._write_cache(name, dependencies, template)
+        self.templates[name] = template
+        self._dependencies[name] = dependencies
+
+    def _modified(self, name):
+        for dependency, mtime in self._dependencies[name].iteritems():
+            try:
+                if os.stat(os.path.join(self.root, dependency)).st_mtime \
+                   != mtime:
+                    return True
+            except OSError:
+                return True
+        return False
+
+    def _cache_path(self, name):
+        path = os.path.join(self.root, name)
+        return os.path.join(self.cache_directory,
+                            hashlib.sha1(path).hexdigest() + ".tmpl")
+
+    def _read_cache(self, name):
+        """Returns (dependencies, code, code object) if the cache is fresh."""
+        if not self.cache_directory:
+            return None
+        try:
+            f = open(self._cache_path(name), "rb")
+            try:
+                magic, dependencies, code, compiled = marshal.load(f)
+            finally:
+                f.close()
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+        if magic != _CACHE_MAGIC:
+            return None
+        self._dependencies[name] = dependencies
+        if self._modified(name):
+            del self._dependencies[name]
+            return None
+        return dependencies, code, compiled
+
+    def _write_cache(self, name, dependencies, template):
+        if not self.cache_directory:
+            return
+        path = self._cache_path(name)
+        temp_path = "%s.%d" % (path, os.getpid())
+        try:
+            if not os.path.isdir(self.cache_directory):
+                os.makedirs(self.cache_directory)
+            f = open(temp_path, "wb")
+            try:
+                marshal.dump((_CACHE_MAGIC, dependencies, template.code,
+                              template.compiled), f)
+            finally:
+                f.close()
+            os.rename(temp_path, path)
+        except (IOError, OSError):
+            logging.warning("Could not write template cache %s", path,
+                            exc_info=True)
+
+
+# Compiled templates are only usable by the same Python bytecode version
+_CACHE_MAGIC = imp.get_magic() + "tmpl1"
+
 
 class _Node(object):
     def each_child(self):
@@ -207,7 +403,10 @@ class _File(_Node):
         with writer.indent():
             writer.write_line("_buffer = []")
             self.body.generate(writer)
-            writer.write_line("return ''.join(_buffer)")
+            if writer.streaming:
+                writer.write_line("yield ''.join(_buffer)")
+            else:
+                writer.write_line("return ''.join(_buffer)")
 
     def each_child(self):
         return (self.body,)
@@ -276,10 +475,12 @@ class _ApplyBlock(_Node):
         method_name = "apply%d" % writer.apply_counter
         writer.apply_counter += 1
         writer.write_line("def %s():" % method_name)
+        writer.apply_depth += 1
         with writer.indent():
             writer.write_line("_buffer = []")
             self.body.generate(writer)
             writer.write_line("return ''.join(_buffer)")
+        writer.apply_depth -= 1
         writer.write_line("_buffer.append(%s(%s()))" % (
             self.method, method_name))
 
@@ -296,6 +497,8 @@ class _ControlBlock(_Node):
         writer.write_line("%s:" % self.statement)
         with writer.indent():
             self.body.generate(writer)
+            if self.statement.startswith(("for ", "while ")):
+                writer.write_yield()
 
 
 class _IntermediateControlBlock(_Node):
@@ -342,6 +545,7 @@ class _Text(_Node):
 
         if value:
             writer.write_line('_buffer.append(%r)' % value)
+            writer.write_yield()
 
 
 class ParseError(Exception):
@@ -350,14 +554,20 @@ class ParseError(Exception):
 
 
 class _CodeWriter(object):
+    # When streaming, we yield the buffered output once it has this many
+    # pieces in it
+    STREAM_PIECES = 512
+
     def __init__(self, file, named_blocks, loader, current_template,
-                 compress_whitespace):
+                 compress_whitespace, streaming=False):
         self.file = file
         self.named_blocks = named_blocks
         self.loader = loader
         self.current_template = current_template
         self.compress_whitespace = compress_whitespace
+        self.streaming = streaming
         self.apply_counter = 0
+        self.apply_depth = 0
         self._indent = 0
 
     def indent(self):
@@ -374,6 +584,16 @@ class _CodeWriter(object):
         assert self._indent > 0
         self._indent -= 1
 
+    def write_yield(self):
+        """Writes code that yields the output so far if there is enough.
+
+        Does nothing unless we are streaming, or inside an {% apply %}
+        block, whose output has to be passed to its function in one piece.
+        """
+        if self.streaming and not self.apply_depth:
+            self.write_line("if len(_buffer) >= %d: yield ''.join(_buffer); "
+                            "_buffer = []" % self.STREAM_PIECES)
+
     def write_line(self, line, indent=None):
         if indent == None:
             indent = self._indent
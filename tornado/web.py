@@ -47,21 +47,21 @@ import base64
 import binascii
 import calendar
 import Cookie
-import cStringIO
 import datetime
 import email.utils
 import escape
 import functools
-import gzip
 import hashlib
 import hmac
 import httplib
+import ioloop
 import locale
 import logging
 import mimetypes
 import os.path
 import re
 import stat
+import struct
 import sys
 import template
 import time
@@ -69,6 +69,7 @@ import types
 import urllib
 import urlparse
 import uuid
+import zlib
 
 
 class RequestHandler(object):
@@ -80,12 +81,27 @@ class RequestHandler(object):
     """
     SUPPORTED_METHODS = ("GET", "HEAD", "POST", "DELETE", "PUT")
 
+    # The largest request body we accept, in bytes. If None, we use the
+    # HTTPServer limit for buffered bodies and no limit for streamed ones.
+    # A route can override it with a "max_body_size" keyword argument.
+    MAX_BODY_SIZE = None
+
+    # If True, the request body is not buffered. The handler is executed
+    # as soon as the headers arrive: prepare() runs first, data_received()
+    # is called with each piece of the body, and then get()/post()/etc. is
+    # called once the whole body has arrived.
+    STREAM_REQUEST_BODY = False
+
     def __init__(self, application, request, transforms=None):
         self.application = application
         self.request = request
         self._headers_written = False
         self._finished = False
         self._auto_finish = True
+        self._deadline_timeout = None
+        self._deadline_expired = False
+        self.deadline = None
+        self._body_chunks = []
         self._transforms = transforms or []
         self.ui = _O((n, self._ui_method(m)) for n, m in
                      application.ui_methods.iteritems())
@@ -120,6 +136,15 @@ class RequestHandler(object):
         """
         pass
 
+    def data_received(self, chunk):
+        """Called with each piece of a streamed request body.
+
+        Only used for handlers with STREAM_REQUEST_BODY set. By default,
+        the pieces are collected and set as request.body before
+        get()/post()/etc. is called, as if the body had been buffered.
+        """
+        self._body_chunks.append(chunk)
+
     def clear(self):
         """Resets all headers and content for this response."""
         self._headers = {
@@ -291,6 +316,8 @@ class RequestHandler(object):
         If the given chunk is a dictionary, we write it as JSON and set
         the Content-Type of the response to be text/javascript.
         """
+        if self._finished and self._deadline_expired:
+            return
         assert not self._finished
         if isinstance(chunk, dict):
             chunk = escape.json_encode(chunk)
@@ -298,6 +325,23 @@ class RequestHandler(object):
         chunk = _utf8(chunk)
         self._write_buffer.append(chunk)
 
+    def write_json(self, value):
+        """Writes value as JSON as the response, sending it in pieces.
+
+        Large results, like a scan over many records, are encoded and
+        flushed a piece at a time with escape.json_iterencode, waiting for
+        the connection to drain between pieces. The request is finished
+        once the whole value has been sent, so do not call finish()
+        yourself.
+        """
+        self.set_header("Content-Type", "text/javascript; charset=UTF-8")
+        chunks = escape.json_iterencode(value)
+        if self.application._wsgi:
+            self.finish("".join(chunks))
+            return
+        self._auto_finish = False
+        self._send_chunks(chunks)
+
     def render(self, template_name, **kwargs):
         """Renders the template with the given arguments as the response."""
         html = self.render_string(template_name, **kwargs)
@@ -367,12 +411,43 @@ class RequestHandler(object):
 
         self.finish(html)
 
+    def render_stream(self, template_name, **kwargs):
+        """Renders the template as the response, sending it in pieces.
+
+        Each piece is flushed as soon as the template produces it, and we
+        wait for the connection to drain before generating the next, so
+        the start of a large page reaches the client before the rest is
+        rendered. The request is finished when the template is done, so
+        do not call finish() yourself. Unlike render(), this does not
+        insert the JavaScript and CSS of UI modules into the page.
+        """
+        chunks = self._load_template(template_name).generate_stream(
+            **self._template_args(kwargs))
+        if self.application._wsgi:
+            self.finish("".join(chunks))
+            return
+        self._auto_finish = False
+        self._send_chunks(chunks)
+
+    def _send_chunks(self, chunks):
+        for chunk in chunks:
+            if chunk:
+                self.write(chunk)
+                self.flush(callback=self.async_callback(
+                    self._send_chunks, chunks))
+                return
+        self.finish()
+
     def render_string(self, template_name, **kwargs):
         """Generate the given template with the given arguments.
 
         We return the generated string. To generate and write a template
         as a response, use render() above.
         """
+        t = self._load_template(template_name)
+        return t.generate(**self._template_args(kwargs))
+
+    def _load_template(self, template_name):
         # If no template_path is specified, use the path of the calling file
         template_path = self.application.settings.get("template_path")
         if not template_path:
@@ -381,12 +456,10 @@ class RequestHandler(object):
             while frame.f_code.co_filename == web_file:
                 frame = frame.f_back
             template_path = os.path.dirname(frame.f_code.co_filename)
-        if not getattr(RequestHandler, "_templates", None):
-            RequestHandler._templates = {}
-        if template_path not in RequestHandler._templates:
-            RequestHandler._templates[template_path] = template.Loader(
-                template_path)
-        t = RequestHandler._templates[template_path].load(template_name)
+        loader = _template_loader(template_path, self.application.settings)
+        return loader.load(template_name)
+
+    def _template_args(self, kwargs):
         args = dict(
             handler=self,
             request=self.request,
@@ -398,12 +471,19 @@ class RequestHandler(object):
         )
         args.update(self.ui)
         args.update(kwargs)
-        return t.generate(**args)
+        return args
+
+    def flush(self, include_footers=False, callback=None):
+        """Flushes the current output buffer to the nextwork.
 
-    def flush(self, include_footers=False):
-        """Flushes the current output buffer to the nextwork."""
+        If callback is given, it is called once the connection has sent
+        enough of its buffered output to accept more. Handlers that write
+        large responses in pieces should wait for it between flushes.
+        """
         if self.application._wsgi:
             raise Exception("WSGI applications do not support flush()")
+        if self._finished and self._deadline_expired:
+            return
 
         chunk = "".join(self._write_buffer)
         self._write_buffer = []
@@ -420,14 +500,18 @@ class RequestHandler(object):
 
         # Ignore the chunk and only write the headers for HEAD requests
         if self.request.method == "HEAD":
-            if headers: self.request.write(headers)
+            if headers or callback:
+                self.request.write(headers, callback)
             return
 
-        if headers or chunk:
-            self.request.write(headers + chunk)
+        if headers or chunk or callback:
+            self.request.write(headers + chunk, callback)
 
     def finish(self, chunk=None):
         """Finishes this response, ending the HTTP request."""
+        if self._finished and self._deadline_expired:
+            # We already gave up on this request and sent a 504
+            return
         assert not self._finished
         if chunk: self.write(chunk)
 
@@ -454,6 +538,55 @@ class RequestHandler(object):
             self.request.finish()
             self._log()
         self._finished = True
+        self._clear_deadline()
+
+    def send_file(self, path, include_body=True):
+        """Finishes this response with the contents of the given file.
+
+        The file is streamed from disk by the connection rather than read
+        into memory, so set any other headers before calling this method.
+        A Range header asking for a single byte range is answered with a
+        206 Partial Content response. It is ignored for empty files, which
+        have no byte ranges to satisfy.
+        """
+        assert not self._headers_written
+        size = os.path.getsize(path)
+        start, end = 0, size
+        self.set_header("Accept-Ranges", "bytes")
+        range_header = self.request.headers.get("Range")
+        if range_header and size and self._status_code == 200:
+            byte_range = _parse_range_header(range_header, size)
+            if byte_range is None:
+                self.set_status(416)
+                self.set_header("Content-Range", "bytes */%d" % size)
+                self.set_header("Content-Length", 0)
+                self.finish()
+                return
+            start, end = byte_range
+            if (start, end) != (0, size):
+                self.set_status(206)
+                self.set_header("Content-Range", "bytes %d-%d/%d" % (
+                    start, end - 1, size))
+        self.set_header("Content-Length", end - start)
+        if not include_body or self.request.method == "HEAD" or \
+           start == end:
+            self.finish()
+            return
+
+        file = open(path, "rb")
+        if self.application._wsgi:
+            try:
+                file.seek(start)
+                self.finish(file.read(end - start))
+            finally:
+                file.close()
+            return
+        self.flush()
+        self.request.write_file(file, start, end - start)
+        self.request.finish()
+        self._log()
+        self._finished = True
+        self._clear_deadline()
 
     def send_error(self, status_code=500):
         """Sends the given HTTP error code to the browser.
@@ -652,6 +785,9 @@ class RequestHandler(object):
         if args or kwargs:
             callback = functools.partial(callback, *args, **kwargs)
         def wrapper(*args, **kwargs):
+            if self._deadline_expired:
+                # We already gave up on this request
+                return
             try:
                 return callback(*args, **kwargs)
             except Exception, e:
@@ -672,18 +808,108 @@ class RequestHandler(object):
         """Executes this request with the given output transforms."""
         self._transforms = transforms
         try:
-            if self.request.method not in self.SUPPORTED_METHODS:
-                raise HTTPError(405)
-            # If XSRF cookies are turned on, reject form submissions without
-            # the proper cookie
-            if self.request.method == "POST" and \
-               self.application.settings.get("xsrf_cookies"):
-                self.check_xsrf_cookie()
-            self.prepare()
-            if not self._finished:  
-                getattr(self, self.request.method.lower())(*args, **kwargs)
-                if self._auto_finish and not self._finished:
-                    self.finish()
+            self._execute_prepare()
+            if not self._finished:
+                self._execute_method(*args, **kwargs)
+        except Exception, e:
+            self._handle_request_exception(e)
+
+    def remaining_time(self):
+        """Returns the seconds left before this request's deadline.
+
+        Returns None if the request has no deadline. See the
+        request_timeout setting of Application.
+        """
+        if self.deadline is None:
+            return None
+        return self.deadline - time.time()
+
+    def _start_deadline(self):
+        timeout = self.settings.get("request_timeout")
+        header = self.request.headers.get("X-Request-Timeout")
+        if header:
+            try:
+                requested = float(header)
+            except ValueError:
+                raise HTTPError(400, "Bad X-Request-Timeout: %r", header)
+            # Clients may ask for less time than we allow, but not more
+            if requested > 0 and (timeout is None or requested < timeout):
+                timeout = requested
+        if not timeout:
+            return
+        self.deadline = self.request._start_time + timeout
+        if not self.application._wsgi:
+            self._deadline_timeout = ioloop.IOLoop.instance().add_timeout(
+                self.deadline, self._on_deadline)
+
+    def _clear_deadline(self):
+        if self._deadline_timeout is not None:
+            ioloop.IOLoop.instance().remove_timeout(self._deadline_timeout)
+            self._deadline_timeout = None
+
+    def _on_deadline(self):
+        self._deadline_timeout = None
+        if self._finished:
+            return
+        self._deadline_expired = True
+        logging.warning("Deadline exceeded after %.2fms: %s",
+                        1000.0 * self.request.request_time(),
+                        self._request_summary())
+        if self._headers_written:
+            # Too late to send a 504. Closing the connection without ending
+            # the response tells the client it was cut short.
+            self._status_code = 504
+            self._finished = True
+            self._log()
+            self.request.connection.stream.close()
+            return
+        self.send_error(504)
+
+    def _execute_prepare(self):
+        if self.request.method not in self.SUPPORTED_METHODS:
+            raise HTTPError(405)
+        self._start_deadline()
+        # If XSRF cookies are turned on, reject form submissions without
+        # the proper cookie
+        if self.request.method == "POST" and \
+           self.application.settings.get("xsrf_cookies"):
+            self.check_xsrf_cookie()
+        self.prepare()
+
+    def _execute_method(self, *args, **kwargs):
+        getattr(self, self.request.method.lower())(*args, **kwargs)
+        if self._auto_finish and not self._finished:
+            self.finish()
+
+    def _start_streaming(self, transforms):
+        """Runs prepare() for a request whose body will be streamed."""
+        self._transforms = transforms
+        try:
+            self._execute_prepare()
+        except Exception, e:
+            self._handle_request_exception(e)
+
+    def _stream_data(self, chunk):
+        if self._finished:
+            return
+        try:
+            self.data_received(chunk)
+        except Exception, e:
+            self._handle_request_exception(e)
+
+    def _stream_error(self, status_code):
+        if self._finished:
+            return
+        self._handle_request_exception(HTTPError(status_code))
+
+    def _stream_finish(self, *args):
+        if self._finished:
+            return
+        if self._body_chunks:
+            self.request.body = "".join(self._body_chunks)
+            self._body_chunks = []
+        try:
+            self._execute_method(*args)
         except Exception, e:
             self._handle_request_exception(e)
 
@@ -846,13 +1072,35 @@ class Application(object):
     You can serve static files by sending the static_path setting as a
     keyword argument. We will serve those files from the /static/ URI,
     and we will serve /favicon.ico and /robots.txt from the same directory.
+
+    Templates are loaded from the template_path setting. Set
+    template_cache_path to save compiled templates to that directory for
+    later processes, and preload_templates to compile every template
+    when the application is created, before HTTPServer.start() forks.
+    preload_templates may be a list of file name extensions to preload
+    instead of template.Loader.TEMPLATE_EXTENSIONS.
+
+    Set request_timeout to the seconds a request may take. Clients can
+    ask for less with an X-Request-Timeout header. A handler which has
+    not finished by then is sent a 504 response, and callbacks wrapped
+    with async_callback are no longer called; its later write(), flush()
+    and finish() calls are ignored. Synchronous handlers should
+    pass the deadline on to whatever they block on; see
+    RequestHandler.deadline and remaining_time().
     """
     def __init__(self, handlers=None, default_host="", transforms=None,
                  wsgi=False, **settings):
         if transforms is None:
             self.transforms = []
             if settings.get("gzip"):
-                self.transforms.append(GZipContentEncoding)
+                cache = None
+                if settings.get("gzip_cache_size"):
+                    cache = _GZipCache(settings["gzip_cache_size"])
+                self.transforms.append(functools.partial(
+                    GZipContentEncoding,
+                    level=settings.get("gzip_level"),
+                    min_length=settings.get("gzip_min_length"),
+                    cache=cache))
             self.transforms.append(ChunkedTransferEncoding)
         else:
             self.transforms = transforms
@@ -873,6 +1121,11 @@ class Application(object):
                 (r"/(robots\.txt)", StaticFileHandler, dict(path=path)),
             ])
         if handlers: self.add_handlers(".*$", handlers)
+        preload = self.settings.get("preload_templates")
+        if self.settings.get("template_path") and preload:
+            _template_loader(self.settings["template_path"],
+                             self.settings).preload(
+                None if preload is True else preload)
 
         # Automatically reload modified modules
         if self.settings.get("debug") and not wsgi:
@@ -883,7 +1136,7 @@ class Application(object):
         """Appends the given handlers to our handler list."""
         if not host_pattern.endswith("$"):
             host_pattern += "$"
-        handlers = []
+        handlers = _Router()
         self.handlers.append((re.compile(host_pattern), handlers))
 
         for handler_tuple in host_handlers:
@@ -891,12 +1144,14 @@ class Application(object):
             pattern = handler_tuple[0]
             handler = handler_tuple[1]
             if len(handler_tuple) == 3:
-                kwargs = handler_tuple[2]
+                kwargs = dict(handler_tuple[2])
             else:
                 kwargs = {}
+            max_body_size = kwargs.pop("max_body_size", handler.MAX_BODY_SIZE)
             if not pattern.endswith("$"):
                 pattern += "$"
-            handlers.append((re.compile(pattern), handler, kwargs))
+            handlers.add((re.compile(pattern), handler, kwargs,
+                          max_body_size))
 
     def add_transform(self, transform_class):
         """Adds the given OutputTransform to our transform list."""
@@ -941,35 +1196,193 @@ class Application(object):
                 except TypeError:
                     pass
 
+    def _find_route(self, request):
+        """Returns (handler_class, kwargs, args, max_body_size) or None."""
+        handlers = self._get_host_handlers(request)
+        if not handlers:
+            return None
+        return handlers.find(request.path)
+
+    def start_request(self, request):
+        """Called by HTTPServer before the body of a request is read.
+
+        If the body is larger than the max_body_size of the matching
+        route, we respond with a 413 error right away. If the handler
+        streams its body, we execute it now and return an object that
+        passes it the body as it arrives. Otherwise we return None, and
+        the request is executed by __call__ once the body has been read.
+        """
+        route = self._find_route(request)
+        if not route:
+            return None
+        handler_class, kwargs, args, max_body_size = route
+        # Chunked bodies are checked by HTTPServer as they arrive
+        request.max_body_size = max_body_size
+        content_length = int(request.headers.get("Content-Length", 0))
+        if max_body_size is not None and content_length > max_body_size:
+            handler = ErrorHandler(self, request, 413)
+            handler._execute([t(request) for t in self.transforms])
+            return None
+        if not handler_class.STREAM_REQUEST_BODY:
+            return None
+        handler = handler_class(self, request, **kwargs)
+        handler._start_streaming([t(request) for t in self.transforms])
+        return _StreamedBody(handler, args)
+
     def __call__(self, request):
         """Called by HTTPServer to execute the request."""
         transforms = [t(request) for t in self.transforms]
         handler = None
         args = []
         handlers = self._get_host_handlers(request)
-        if not handlers: 
+        if not handlers:
             handler = RedirectHandler(
                 request, "http://" + self.default_host + "/")
         else:
-            for pattern, handler_class, kwargs in handlers:
-                match = pattern.match(request.path)
-                if match:
-                    handler = handler_class(self, request, **kwargs)
-                    args = match.groups()
-                    break
-            if not handler:
+            route = handlers.find(request.path)
+            if route:
+                handler_class, kwargs, args, max_body_size = route
+                handler = handler_class(self, request, **kwargs)
+            else:
                 handler = ErrorHandler(self, request, 404)
 
-        # In debug mode, re-compile templates and reload static files on every
-        # request so you don't need to restart to see changes
+        # In debug mode, reload static files on every request so you don't
+        # need to restart to see changes. Template loaders check for
+        # modified templates themselves.
         if self.settings.get("debug"):
-            RequestHandler._templates = None
             RequestHandler._static_hashes = {}
 
         handler._execute(transforms, *args)
         return handler
 
 
+def _template_loader(template_path, settings):
+    """Returns the shared template.Loader for the given directory."""
+    if not getattr(RequestHandler, "_templates", None):
+        RequestHandler._templates = {}
+    if template_path not in RequestHandler._templates:
+        RequestHandler._templates[template_path] = template.Loader(
+            template_path,
+            cache_directory=settings.get("template_cache_path"),
+            check_mtime=bool(settings.get("debug")))
+    return RequestHandler._templates[template_path]
+
+
+class _Router(object):
+    """The handlers for one host, which finds the handler for a path.
+
+    As before, the first pattern in the list that matches the path wins.
+    To avoid trying every pattern, we index patterns by the first path
+    segment when their literal prefix spells it out (e.g., r"/static/.*"),
+    so a path is only tried against patterns for its first segment and
+    patterns that could match any path. Results for recently requested
+    paths are cached.
+    """
+    CACHE_SIZE = 1000
+
+    def __init__(self):
+        self.routes = []
+        self._by_segment = {}
+        self._unindexed = []
+        self._candidates = {}
+        self._cache = {}
+
+    def __len__(self):
+        return len(self.routes)
+
+    def __iter__(self):
+        return iter(self.routes)
+
+    def add(self, route):
+        """Adds a (regex, handler_class, kwargs, max_body_size) tuple."""
+        index = len(self.routes)
+        self.routes.append(route)
+        segment = _first_segment(route[0].pattern)
+        if segment is None:
+            self._unindexed.append(index)
+        else:
+            self._by_segment.setdefault(segment, []).append(index)
+        self._candidates = {}
+        self._cache = {}
+
+    def find(self, path):
+        """Returns (handler_class, kwargs, args, max_body_size) or None."""
+        try:
+            return self._cache[path]
+        except KeyError:
+            pass
+        segment = path[1:].split("/", 1)[0]
+        candidates = self._candidates.get(segment)
+        if candidates is None:
+            if segment in self._by_segment:
+                candidates = sorted(self._by_segment[segment] +
+                                    self._unindexed)
+                self._candidates[segment] = candidates
+            else:
+                candidates = self._unindexed
+        result = None
+        for index in candidates:
+            pattern, handler_class, kwargs, max_body_size = self.routes[index]
+            match = pattern.match(path)
+            if match:
+                result = (handler_class, kwargs, match.groups(),
+                          max_body_size)
+                break
+        if len(self._cache) >= self.CACHE_SIZE:
+            self._cache.clear()
+        self._cache[path] = result
+        return result
+
+
+def _first_segment(pattern):
+    """Returns the first path segment every match of pattern starts with.
+
+    Returns None if the pattern's literal prefix doesn't spell out a
+    whole segment, e.g. r"/(.*)" or r"/foo.*".
+    """
+    if "|" in pattern or not pattern.startswith("/"):
+        return None
+    literal = []
+    i = 1
+    while i < len(pattern):
+        char = pattern[i]
+        if char == "\\" and i + 1 < len(pattern) and \
+           not pattern[i + 1].isalnum():
+            char = pattern[i + 1]
+            i += 1
+        elif char in ".^$*+?{}[]()\\":
+            if char == "$" and i == len(pattern) - 1:
+                return "".join(literal)
+            if char in "*?{" and literal:
+                # The quantifier makes the last character optional
+                literal.pop()
+            return None
+        if char == "/":
+            # The segment is complete unless a quantifier follows
+            if i + 1 < len(pattern) and pattern[i + 1] in "*?{":
+                return None
+            return "".join(literal)
+        literal.append(char)
+        i += 1
+    return None
+
+
+class _StreamedBody(object):
+    """Passes a request body to a handler as HTTPConnection reads it."""
+    def __init__(self, handler, args):
+        self.handler = handler
+        self.args = args
+
+    def data_received(self, chunk):
+        self.handler._stream_data(chunk)
+
+    def finish(self):
+        self.handler._stream_finish(*self.args)
+
+    def body_too_large(self):
+        self.handler._stream_error(413)
+
+
 class HTTPError(Exception):
     """An exception that will turn into an HTTP error response."""
     def __init__(self, status_code, log_message=None, *args):
@@ -1061,7 +1474,6 @@ class StaticFileHandler(RequestHandler):
                 return
 
         self.set_header("Last-Modified", modified)
-        self.set_header("Content-Length", stat_result[stat.ST_SIZE])
         if "v" in self.request.arguments:
             self.set_header("Expires", datetime.datetime.utcnow() + \
                                        datetime.timedelta(days=365*10))
@@ -1072,13 +1484,7 @@ class StaticFileHandler(RequestHandler):
         if mime_type:
             self.set_header("Content-Type", mime_type)
 
-        if not include_body:
-            return
-        file = open(abspath, "r")
-        try:
-            self.write(file.read())
-        finally:
-            file.close()
+        self.send_file(abspath, include_body)
 
 
 class FallbackHandler(RequestHandler):
@@ -1124,48 +1530,103 @@ class OutputTransform(object):
 class GZipContentEncoding(OutputTransform):
     """Applies the gzip content encoding to the response.
 
+    The compression level and the smallest response we bother compressing
+    default to LEVEL and MIN_LENGTH. If a cache is given, complete
+    responses with an Etag are compressed once and the compressed body is
+    reused for later responses with the same Etag. Application sets all
+    three from its gzip_level, gzip_min_length and gzip_cache_size
+    settings.
+
     See http://www.w3.org/Protocols/rfc2616/rfc2616-sec14.html#sec14.11
     """
     CONTENT_TYPES = set([
         "text/plain", "text/html", "text/css", "text/xml",
         "application/x-javascript", "application/xml", "application/atom+xml",
         "text/javascript", "application/json", "application/xhtml+xml"])
-    MIN_LENGTH = 5
+    LEVEL = 6
+    MIN_LENGTH = 1024
 
-    def __init__(self, request):
+    # Header with no file name or modification time; see RFC 1952
+    _HEADER = "\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+
+    def __init__(self, request, level=None, min_length=None, cache=None):
         self._gzipping = request.supports_http_1_1() and \
             "gzip" in request.headers.get("Accept-Encoding", "")
+        self._level = self.LEVEL if level is None else level
+        self._min_length = self.MIN_LENGTH if min_length is None \
+            else min_length
+        self._cache = cache
 
     def transform_first_chunk(self, headers, chunk, finishing):
         if self._gzipping:
             ctype = headers.get("Content-Type", "").split(";")[0]
             self._gzipping = (ctype in self.CONTENT_TYPES) and \
-                (not finishing or len(chunk) >= self.MIN_LENGTH) and \
+                (not finishing or len(chunk) >= self._min_length) and \
                 (finishing or "Content-Length" not in headers) and \
                 ("Content-Encoding" not in headers)
         if self._gzipping:
             headers["Content-Encoding"] = "gzip"
-            self._gzip_value = cStringIO.StringIO()
-            self._gzip_file = gzip.GzipFile(mode="w", fileobj=self._gzip_value)
-            self._gzip_pos = 0
-            chunk = self.transform_chunk(chunk, finishing)
+            etag = headers.get("Etag")
+            if finishing and etag and self._cache is not None:
+                compressed = self._cache.get(etag)
+                if compressed is None:
+                    compressed = self._compress_body(chunk)
+                    self._cache.set(etag, compressed)
+                chunk = compressed
+            else:
+                self._compressor = zlib.compressobj(
+                    self._level, zlib.DEFLATED, -zlib.MAX_WBITS)
+                self._crc = zlib.crc32("")
+                self._size = 0
+                chunk = self._HEADER + self.transform_chunk(chunk, finishing)
             if "Content-Length" in headers:
                 headers["Content-Length"] = str(len(chunk))
         return headers, chunk
 
     def transform_chunk(self, chunk, finishing):
         if self._gzipping:
-            self._gzip_file.write(chunk)
+            self._crc = zlib.crc32(chunk, self._crc)
+            self._size += len(chunk)
+            data = self._compressor.compress(chunk)
             if finishing:
-                self._gzip_file.close()
+                chunk = data + self._compressor.flush() + struct.pack(
+                    "<LL", self._crc & 0xffffffffL, self._size & 0xffffffffL)
             else:
-                self._gzip_file.flush()
-            chunk = self._gzip_value.getvalue()
-            if self._gzip_pos > 0:
-                chunk = chunk[self._gzip_pos:]
-            self._gzip_pos += len(chunk)
+                chunk = data + self._compressor.flush(zlib.Z_SYNC_FLUSH)
         return chunk
 
+    def _compress_body(self, body):
+        compressor = zlib.compressobj(
+            self._level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return "".join([
+            self._HEADER, compressor.compress(body), compressor.flush(),
+            struct.pack("<LL", zlib.crc32(body) & 0xffffffffL,
+                        len(body) & 0xffffffffL)])
+
+
+class _GZipCache(object):
+    """Compressed response bodies keyed by Etag, up to max_size bytes.
+
+    When the cache fills up, we drop everything and start over, which
+    keeps the bodies that are actually hot without any bookkeeping.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._bodies = {}
+        self._size = 0
+
+    def get(self, etag):
+        return self._bodies.get(etag)
+
+    def set(self, etag, body):
+        if len(body) > self.max_size:
+            return
+        if self._size + len(body) > self.max_size:
+            self._bodies.clear()
+            self._size = 0
+        self._bodies[etag] = body
+        self._size += len(body)
+
 
 class ChunkedTransferEncoding(OutputTransform):
     """Applies the chunked transfer encoding to the response.
@@ -1253,6 +1714,36 @@ class UIModule(object):
         return self.handler.render_string(path, **kwargs)
 
 
+def _parse_range_header(value, size):
+    """Parses a Range header for a resource of the given size.
+
+    Returns a (start, end) tuple, with end exclusive, or None if the range
+    cannot be satisfied. Headers we do not support, including ones with
+    multiple ranges, give the whole resource since RFC 2616 lets us ignore
+    them.
+    """
+    unit, sep, spec = value.partition("=")
+    if unit.strip() != "bytes" or not sep or "," in spec:
+        return 0, size
+    first, sep, last = spec.strip().partition("-")
+    try:
+        if not first:
+            # A suffix range: the last N bytes of the resource
+            length = int(last)
+            if length <= 0:
+                return None
+            return max(size - length, 0), size
+        start = int(first)
+        end = int(last) + 1 if last else size
+    except ValueError:
+        return 0, size
+    if start >= size:
+        return None
+    if end <= start:
+        return 0, size
+    return start, min(end, size)
+
+
 def _utf8(s):
     if isinstance(s, unicode):
         return s.encode("utf-8")